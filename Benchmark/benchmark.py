@@ -0,0 +1,280 @@
+import argparse
+import itertools
+import json
+import os
+import resource
+import shlex
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../')))
+from Shared.shared import *
+from Benchmark.impairment_proxy import add_impairment_args
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '../'))
+SERVER_SCRIPT = os.path.join(ROOT, 'Server', 'server.py')
+CLIENT_SCRIPT = os.path.join(ROOT, 'Client', 'client.py')
+PROXY_SCRIPT = os.path.join(ROOT, 'Benchmark', 'impairment_proxy.py')
+DEFAULT_RESULTS = os.path.join(ROOT, 'Benchmark', 'results.jsonl')
+DEFAULT_BASELINE = os.path.join(ROOT, 'Benchmark', 'baseline.json')
+
+# Benchmark tuning
+DEFAULT_BASE_PORT = 20000       # Server TCP/UDP and proxy UDP/TCP ports are base .. base + 3
+START_TIMEOUT = 10              # Seconds for the server or proxy to start listening
+CLIENT_TIMEOUT = 300            # Seconds a single client run may take
+DEFAULT_TOLERANCE = 0.10        # Relative change that counts as a regression
+METRICS = ('goodput_bps', 'tcp_goodput_bps', 'udp_goodput_bps', 'udp_success_rate',
+           'cpu_client_s', 'cpu_server_s', 'cpu_proxy_s', 'cpu_s_per_gb')
+
+
+def int_list(value):
+    return [int(item) for item in value.split(',')]
+
+
+def children_cpu():
+    """CPU seconds used so far by reaped child processes."""
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def wait_for_port(port, timeout=START_TIMEOUT):
+    """Wait until something accepts TCP connections on the loopback port."""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"nothing listening on port {port} after {timeout}s")
+            time.sleep(0.05)
+
+
+def stop(process):
+    """Terminate a child, reap it and return the CPU seconds it used."""
+    cpu = children_cpu()
+    process.terminate()
+    process.wait()
+    return children_cpu() - cpu
+
+
+def point_key(point):
+    """Stable identifier of a benchmark point, used to match it against the baseline."""
+    return (f"size={point['file_size']} buffer={point['buffer_size']} tcp={point['tcp']} udp={point['udp']} "
+            f"impair='{point['impairment']}' client='{point['client_args']}'")
+
+
+def run_once(point, args, idle_cpu=0.0):
+    """Run server, optional proxy and client for one point; return its measurements.
+
+    idle_cpu is the client and server CPU of a run without connections, which
+    is not charged to the bytes delivered.
+    """
+    env = dict(os.environ, SPEEDTEST_BUFFER_SIZE=str(point['buffer_size']))
+    tcp_port, udp_port = args.base_port, args.base_port + 1
+    server = subprocess.Popen([sys.executable, SERVER_SCRIPT, '--tcp-port', str(tcp_port), '--udp-port', str(udp_port),
+                               '--broadcast-address', '127.255.255.255', *shlex.split(args.server_args)],
+                              env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    proxy = None
+    cpu_server = cpu_proxy = 0.0
+    try:
+        wait_for_port(tcp_port)
+        if point['impairment']:
+            proxy_udp_port, proxy_tcp_port = args.base_port + 2, args.base_port + 3
+            proxy = subprocess.Popen([sys.executable, PROXY_SCRIPT, '--server-udp-port', str(udp_port),
+                                      '--server-tcp-port', str(tcp_port), '--udp-port', str(proxy_udp_port),
+                                      '--tcp-port', str(proxy_tcp_port), *shlex.split(point['impairment'])],
+                                     env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            wait_for_port(proxy_tcp_port)
+            tcp_port, udp_port = proxy_tcp_port, proxy_udp_port
+
+        with tempfile.TemporaryDirectory() as directory:
+            metrics_path = os.path.join(directory, 'metrics.jsonl')
+            command = [sys.executable, CLIENT_SCRIPT, '--server', f'127.0.0.1:{udp_port}:{tcp_port}',
+                       '--file-size', str(point['file_size']), '--tcp', str(point['tcp']), '--udp', str(point['udp']),
+                       '--datagram-size', str(point['buffer_size']), '--metrics-jsonl', metrics_path,
+                       *shlex.split(point['client_args'])]
+            cpu = children_cpu()
+            try:
+                exit_code = subprocess.run(command, env=env, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                           stderr=subprocess.DEVNULL, timeout=args.timeout).returncode
+            except subprocess.TimeoutExpired:
+                exit_code = None
+            cpu_client = children_cpu() - cpu
+            records = []
+            if os.path.exists(metrics_path):
+                with open(metrics_path) as metrics_file:
+                    records = [json.loads(line) for line in metrics_file]
+    finally:
+        if proxy is not None:
+            cpu_proxy = stop(proxy)
+        cpu_server = stop(server)
+
+    return measure(records, exit_code, cpu_client, cpu_server, cpu_proxy, idle_cpu)
+
+
+def span(connections):
+    """Seconds from the first connection's start to the last one's end."""
+    finished = [record for record in connections if record['end_time'] is not None]
+    if not finished:
+        return 1e-9
+    return max(max(record['end_time'] for record in finished) - min(record['start_time'] for record in finished), 1e-9)
+
+
+def measure(records, exit_code, cpu_client, cpu_server, cpu_proxy, idle_cpu=0.0):
+    """Reduce a client's metrics records to goodput, success rate and CPU cost."""
+    connections = [record for record in records if record['type'] == 'connection']
+    tcp = [record for record in connections if record['kind'] == 'TCP']
+    udp = [record for record in connections if record['kind'] == 'UDP']
+    tcp_bytes = sum(record['bytes'] for record in tcp if 'error' not in record)
+    udp_bytes = sum(record.get('unique_bytes', record['bytes']) for record in udp)
+    success_rates = [record['success_rate'] for record in udp if 'success_rate' in record]
+    delivered = tcp_bytes + udp_bytes
+    return {
+        'goodput_bps': delivered * 8 / span(connections),
+        'tcp_goodput_bps': tcp_bytes * 8 / span(tcp),
+        'udp_goodput_bps': udp_bytes * 8 / span(udp),
+        'udp_success_rate': statistics.mean(success_rates) if success_rates else None,
+        'cpu_client_s': cpu_client,
+        'cpu_server_s': cpu_server,
+        'cpu_proxy_s': cpu_proxy,
+        # The proxy stands in for the network, so its CPU is not charged to the transfer;
+        # neither is interpreter startup and idling, measured by a run without connections
+        'cpu_s_per_gb': max(0.0, cpu_client + cpu_server - idle_cpu) / (delivered / 1e9) if delivered else None,
+        'errors': sum(1 for record in connections if 'error' in record),
+        'exit_code': exit_code,
+    }
+
+
+def run_point(point, args):
+    """Run a point args.repeat times and keep the median of every metric."""
+    idle = run_once({**point, 'tcp': 0, 'udp': 0}, args)
+    idle_cpu = idle['cpu_client_s'] + idle['cpu_server_s']
+    runs = [run_once(point, args, idle_cpu) for _ in range(args.repeat)]
+    result = {'type': 'point', 'key': point_key(point), 'time': time.time(), **point, 'runs': len(runs),
+              'cpu_idle_s': idle_cpu,
+              'errors': sum(run['errors'] for run in runs),
+              'failed_runs': sum(1 for run in runs if run['exit_code'] != 0)}
+    for metric in METRICS:
+        values = [run[metric] for run in runs if run[metric] is not None]
+        result[metric] = statistics.median(values) if values else None
+    return result
+
+
+def compare(result, baseline, tolerance):
+    """Return the regressions of result against its baseline entry, as printable strings."""
+    regressions = []
+    for metric in ('goodput_bps', 'tcp_goodput_bps', 'udp_goodput_bps'):
+        if result[metric] is not None and baseline.get(metric):
+            if result[metric] < baseline[metric] * (1 - tolerance):
+                regressions.append(f"{metric} {result[metric] / 1e6:.1f} < {baseline[metric] / 1e6:.1f} Mbit/s")
+    if result['cpu_s_per_gb'] is not None and baseline.get('cpu_s_per_gb'):
+        if result['cpu_s_per_gb'] > baseline['cpu_s_per_gb'] * (1 + tolerance):
+            regressions.append(f"cpu_s_per_gb {result['cpu_s_per_gb']:.2f} > {baseline['cpu_s_per_gb']:.2f}")
+    if result['udp_success_rate'] is not None and baseline.get('udp_success_rate') is not None:
+        # Success rates are percentages, so the tolerance applies in points
+        if result['udp_success_rate'] < baseline['udp_success_rate'] - tolerance * 100:
+            regressions.append(f"udp_success_rate {result['udp_success_rate']:.2f}% < "
+                               f"{baseline['udp_success_rate']:.2f}%")
+    return regressions
+
+
+def format_result(result):
+    success = result['udp_success_rate']
+    cpu = result['cpu_s_per_gb']
+    return (f"Goodput: {result['goodput_bps'] / 1e6:.1f} Mbit/s (TCP {result['tcp_goodput_bps'] / 1e6:.1f}, "
+            f"UDP {result['udp_goodput_bps'] / 1e6:.1f}), "
+            f"UDP Success: {'-' if success is None else f'{success:.2f}%'}, "
+            f"CPU: {'-' if cpu is None else f'{cpu:.2f}'} s/GB")
+
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as baseline_file:
+        return json.load(baseline_file)
+
+
+def points(args):
+    """Every combination of the swept parameters, skipping runs without connections."""
+    for file_size, buffer_size, tcp, udp, impairment in itertools.product(
+            args.file_sizes, args.buffer_sizes, args.tcp, args.udp, args.impair or ['']):
+        if tcp or udp:
+            yield {'file_size': file_size, 'buffer_size': buffer_size, 'tcp': tcp, 'udp': udp,
+                   'impairment': impairment, 'client_args': args.client_args}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Loopback benchmark sweep for the speed test")
+    parser.add_argument('--file-sizes', type=int_list, default=[10_000_000], help="comma-separated file sizes in bytes")
+    parser.add_argument('--buffer-sizes', type=int_list, default=[BUFFER_SIZE],
+                        help="comma-separated UDP datagram sizes in bytes (BUFFER_SIZE and the client's --datagram-size)")
+    parser.add_argument('--tcp', type=int_list, default=[0, 1], help="comma-separated TCP connection counts")
+    parser.add_argument('--udp', type=int_list, default=[0, 1], help="comma-separated UDP connection counts")
+    parser.add_argument('--impair', action='append', metavar='PROXY_ARGS',
+                        help="run through impairment_proxy.py with these options, e.g. --impair=\"--loss 1 --delay 5\"; "
+                             "repeat for several profiles, '' for a direct run")
+    parser.add_argument('--client-args', default='', help="extra client options, e.g. --client-args=\"--reliable --processes 2\"")
+    parser.add_argument('--server-args', default='', help="extra server options, e.g. --server-args=--udp-adaptive")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per point; the median is kept")
+    parser.add_argument('--results', default=DEFAULT_RESULTS, help="JSON lines file results are appended to")
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help="JSON file of stored results to compare against")
+    parser.add_argument('--save-baseline', action='store_true', help="store this run's results in the baseline file")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help="relative change reported as a regression")
+    parser.add_argument('--base-port', type=int, default=DEFAULT_BASE_PORT)
+    parser.add_argument('--timeout', type=float, default=CLIENT_TIMEOUT, help="seconds one client run may take")
+    args = parser.parse_args()
+    for buffer_size in args.buffer_sizes:
+        if not MIN_DATAGRAM_SIZE <= buffer_size <= MAX_DATAGRAM_SIZE:
+            parser.error(f"buffer size {buffer_size} must be between {MIN_DATAGRAM_SIZE} and {MAX_DATAGRAM_SIZE}")
+    # Catch a bad profile here rather than as a proxy that never starts listening
+    profile_parser = argparse.ArgumentParser(prog='--impair', add_help=False)
+    add_impairment_args(profile_parser)
+    for profile in args.impair or []:
+        profile_parser.parse_args(shlex.split(profile))
+    return args
+
+
+def main():
+    args = parse_args()
+    baseline = load_baseline(args.baseline)
+    results = []
+    regressed = False
+    with open(args.results, 'a') as results_file:
+        for point in points(args):
+            key = point_key(point)
+            print(f"{bcolors.HEADER}{key}{bcolors.ENDC}")
+            result = run_point(point, args)
+            results.append(result)
+            results_file.write(json.dumps(result) + '\n')
+            results_file.flush()
+
+            color = bcolors.OKGREEN
+            notes = []
+            if result['failed_runs'] or result['errors']:
+                color = bcolors.WARNING
+                notes.append(f"{result['failed_runs']} failed run(s), {result['errors']} connection error(s)")
+            if key in baseline:
+                regressions = compare(result, baseline[key], args.tolerance)
+                if regressions:
+                    color = bcolors.FAIL
+                    regressed = True
+                    notes.append("REGRESSION: " + "; ".join(regressions))
+                else:
+                    notes.append(f"within {args.tolerance:.0%} of baseline")
+            print(f"{color}  {format_result(result)}{''.join(f' [{note}]' for note in notes)}{bcolors.ENDC}")
+
+    if args.save_baseline:
+        baseline.update({result['key']: {metric: result[metric] for metric in METRICS} for result in results})
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(baseline, baseline_file, indent=2, sort_keys=True)
+        print(f"{bcolors.OKCYAN}Baseline saved to {args.baseline}{bcolors.ENDC}")
+    sys.exit(1 if regressed else 0)
+
+if __name__ == "__main__":
+    main()
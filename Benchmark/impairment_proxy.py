@@ -0,0 +1,310 @@
+import argparse
+import asyncio
+import random
+import signal
+import socket
+import sys
+import os
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../')))
+from Shared.shared import *
+
+# Proxy tuning
+SOCKET_BUFFER = 4 * 1024 * 1024     # Kernel buffers of the proxy's UDP sockets
+TCP_CHUNK = 64 * 1024               # Bytes read from a TCP connection at a time
+TCP_QUEUE_CHUNKS = 64               # Chunks in flight per TCP direction before reading pauses
+FLOW_IDLE_TIMEOUT = 30              # Seconds before an idle UDP client flow is forgotten
+STATS_INTERVAL = 5                  # Seconds between proxy counter reports
+DEFAULT_PROXY_UDP_PORT = 14118
+DEFAULT_PROXY_TCP_PORT = 14345
+
+# Client datagrams that start a transfer always go to the server's request port
+REQUEST_TYPES = {MESSAGE_TYPE_REQUEST, MESSAGE_TYPE_RELIABLE_REQUEST, MESSAGE_TYPE_RANGE_REQUEST}
+
+
+class Impairment:
+    """Loss, delay, jitter, reordering and a bandwidth cap for one direction of traffic.
+
+    Modelled on netem: packets are lost with probability ``loss``, serialized on
+    a link of ``rate_bps`` with a FIFO queue of at most ``queue_limit`` seconds
+    (tail drop beyond it), then delayed by ``delay`` plus a uniform
+    +/- ``jitter``. Jitter alone reorders packets, as with netem; ``reorder``
+    additionally holds back that fraction of packets by ``reorder_delay``.
+    All times are in seconds and randomness comes from one seeded generator,
+    so a run can be repeated exactly.
+    """
+
+    def __init__(self, loss=0.0, delay=0.0, jitter=0.0, reorder=0.0, reorder_delay=0.002,
+                 rate_bps=0, queue_limit=0.1, seed=None):
+        self.loss = loss
+        self.delay = delay
+        self.jitter = jitter
+        self.reorder = reorder
+        self.reorder_delay = reorder_delay
+        self.rate_bps = rate_bps
+        self.queue_limit = queue_limit
+        self.random = random.Random(seed)
+        self.link_free = 0.0
+        self.last_departure = 0.0
+        self.forwarded = 0
+        self.dropped = 0
+        self.reordered = 0
+
+    def schedule(self, nbytes, now):
+        """Return when a packet arriving now leaves the link, or None if it is dropped."""
+        if self.loss and self.random.random() < self.loss:
+            self.dropped += 1
+            return None
+        ready = now
+        if self.rate_bps:
+            start = max(now, self.link_free)
+            if start - now > self.queue_limit:
+                self.dropped += 1
+                return None
+            self.link_free = ready = start + nbytes * 8 / self.rate_bps
+        delay = self.delay
+        if self.jitter:
+            delay += self.random.uniform(-self.jitter, self.jitter)
+        if self.reorder and self.random.random() < self.reorder:
+            delay += self.reorder_delay
+            self.reordered += 1
+        self.forwarded += 1
+        return ready + max(0.0, delay)
+
+    def schedule_stream(self, nbytes, now):
+        """Like schedule() for a byte stream: nothing is lost and data never overtakes earlier data."""
+        ready = now
+        if self.rate_bps:
+            self.link_free = ready = max(now, self.link_free) + nbytes * 8 / self.rate_bps
+        delay = self.delay + (self.random.uniform(-self.jitter, self.jitter) if self.jitter else 0)
+        self.last_departure = max(self.last_departure, ready + max(0.0, delay))
+        self.forwarded += 1
+        return self.last_departure
+
+    def describe(self):
+        return f"forwarded {self.forwarded}, dropped {self.dropped}, reordered {self.reordered}"
+
+
+class UdpFlow:
+    """Upstream socket and server address of one client talking through the proxy."""
+
+    def __init__(self, client, sock, now):
+        self.client = client
+        self.socket = sock
+        self.server = None      # Where the server last answered from (a per-transfer socket on older servers)
+        self.last_seen = now
+
+
+class ImpairmentProxy:
+    """User-space stand-in for netem between a speed-test client and server.
+
+    UDP: every client address gets its own upstream socket. Requests go to the
+    server's request port; everything else the client sends (feedback, NACKs,
+    PINGs) follows the server's replies to the address they came from.
+    TCP: each accepted connection is relayed through its own upstream
+    connection, delayed and rate limited but never lossy, since loss below TCP
+    cannot be emulated in user space. Bounded queues keep TCP flow control intact.
+    """
+
+    def __init__(self, server_ip, server_udp_port, server_tcp_port, udp_port, tcp_port, down, up):
+        self.server_udp = (server_ip, server_udp_port)
+        self.server_tcp = (server_ip, server_tcp_port)
+        self.udp_port = udp_port
+        self.tcp_port = tcp_port
+        self.down = down        # Server to client
+        self.up = up            # Client to server
+        self.flows = {}
+        self.relays = set()     # TCP relay tasks
+        self.loop = None
+
+    def open_sockets(self):
+        self.udp_socket = self.udp_endpoint(('', self.udp_port))
+        self.tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.tcp_socket.bind(('', self.tcp_port))
+        self.tcp_socket.listen(socket.SOMAXCONN)
+        self.tcp_socket.setblocking(False)
+
+    @staticmethod
+    def udp_endpoint(address):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for option in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+            sock.setsockopt(socket.SOL_SOCKET, option, SOCKET_BUFFER)
+        sock.bind(address)
+        sock.setblocking(False)
+        return sock
+
+    def forward(self, impairment, sock, data, destination):
+        """Send a datagram once the impairment releases it; late sends run from loop timers."""
+        now = self.loop.time()
+        departure = impairment.schedule(len(data), now)
+        if departure is None:
+            return
+        if departure <= now:
+            self.send(sock, data, destination)
+        else:
+            self.loop.call_at(departure, self.send, sock, data, destination)
+
+    @staticmethod
+    def send(sock, data, destination):
+        try:
+            sock.sendto(data, destination)
+        except OSError:
+            pass    # A full socket buffer is one more drop, as on a real link
+
+    def on_client_datagrams(self):
+        """Drain the client-facing UDP socket."""
+        while True:
+            try:
+                data, client = self.udp_socket.recvfrom(65535)
+            except (BlockingIOError, ConnectionError):
+                return
+            now = self.loop.time()
+            flow = self.flows.get(client)
+            if flow is None:
+                flow = self.flows[client] = UdpFlow(client, self.udp_endpoint(('', 0)), now)
+                self.loop.add_reader(flow.socket.fileno(), self.on_server_datagrams, flow)
+            flow.last_seen = now
+            is_request = len(data) > 4 and data[4] in REQUEST_TYPES
+            destination = self.server_udp if is_request or flow.server is None else flow.server
+            self.forward(self.up, flow.socket, data, destination)
+
+    def on_server_datagrams(self, flow):
+        """Drain one flow's upstream socket back to its client."""
+        while True:
+            try:
+                data, flow.server = flow.socket.recvfrom(65535)
+            except (BlockingIOError, ConnectionError):
+                return
+            flow.last_seen = self.loop.time()
+            self.forward(self.down, self.udp_socket, data, flow.client)
+
+    async def expire_flows(self):
+        while True:
+            await asyncio.sleep(FLOW_IDLE_TIMEOUT)
+            deadline = self.loop.time() - FLOW_IDLE_TIMEOUT
+            for client, flow in list(self.flows.items()):
+                if flow.last_seen < deadline:
+                    self.loop.remove_reader(flow.socket.fileno())
+                    flow.socket.close()
+                    del self.flows[client]
+
+    async def accept_tcp(self):
+        while True:
+            conn, addr = await self.loop.sock_accept(self.tcp_socket)
+            conn.setblocking(False)
+            # Keep a reference, or the relay could be garbage-collected mid-connection
+            task = asyncio.create_task(self.relay_tcp(conn))
+            self.relays.add(task)
+            task.add_done_callback(self.relays.discard)
+
+    async def relay_tcp(self, conn):
+        upstream = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        upstream.setblocking(False)
+        try:
+            await self.loop.sock_connect(upstream, self.server_tcp)
+            await asyncio.gather(self.pipe(conn, upstream, self.up), self.pipe(upstream, conn, self.down))
+        except OSError as e:
+            print(f"{bcolors.WARNING}TCP relay ended: {e}{bcolors.ENDC}")
+        finally:
+            conn.close()
+            upstream.close()
+
+    async def pipe(self, source, destination, impairment):
+        """Copy one direction of a TCP connection, releasing each chunk at its scheduled time."""
+        chunks = asyncio.Queue(TCP_QUEUE_CHUNKS)
+
+        async def reader():
+            while True:
+                data = await self.loop.sock_recv(source, TCP_CHUNK)
+                await chunks.put((impairment.schedule_stream(len(data), self.loop.time()), data))
+                if not data:
+                    return
+
+        async def writer():
+            while True:
+                departure, data = await chunks.get()
+                delay = departure - self.loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                if not data:
+                    destination.shutdown(socket.SHUT_WR)
+                    return
+                await self.loop.sock_sendall(destination, data)
+
+        await asyncio.gather(reader(), writer())
+
+    def report(self):
+        print(f"{bcolors.OKCYAN}Proxy: down {self.down.describe()}; up {self.up.describe()}; "
+              f"UDP flows {len(self.flows)}{bcolors.ENDC}")
+
+    async def report_stats(self):
+        while True:
+            await asyncio.sleep(STATS_INTERVAL)
+            self.report()
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.open_sockets()
+        stop = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            self.loop.add_signal_handler(signum, stop.set)
+        self.loop.add_reader(self.udp_socket.fileno(), self.on_client_datagrams)
+        print(f"{bcolors.OKGREEN}Proxy on UDP {self.udp_port} -> {self.server_udp[0]}:{self.server_udp[1]}, "
+              f"TCP {self.tcp_port} -> {self.server_tcp[0]}:{self.server_tcp[1]}{bcolors.ENDC}")
+        tasks = [asyncio.create_task(coroutine) for coroutine in
+                 (self.accept_tcp(), self.expire_flows(), self.report_stats())]
+        await stop.wait()
+        for task in tasks:
+            task.cancel()
+        self.report()
+
+
+def add_impairment_args(parser):
+    """Impairment options shared by the proxy and the benchmark runner's profiles."""
+    parser.add_argument('--loss', type=float, default=0, help="packet loss in percent (UDP only)")
+    parser.add_argument('--delay', type=float, default=0, help="one-way delay in ms")
+    parser.add_argument('--jitter', type=float, default=0, help="uniform +/- delay variation in ms")
+    parser.add_argument('--reorder', type=float, default=0,
+                        help="percent of UDP packets held back by --reorder-delay")
+    parser.add_argument('--reorder-delay', type=float, default=2, help="extra delay of reordered packets in ms")
+    parser.add_argument('--rate', type=float, default=0, help="bandwidth cap in Mbit/s (0 = unlimited)")
+    parser.add_argument('--queue-limit', type=float, default=100,
+                        help="ms of queueing at the bandwidth cap before UDP packets are tail-dropped")
+    parser.add_argument('--direction', choices=('down', 'up', 'both'), default='down',
+                        help="impair server-to-client traffic, client-to-server traffic, or both")
+    parser.add_argument('--seed', type=int, default=1, help="random seed, for repeatable runs")
+
+
+def impairments_from_args(args):
+    """Build the (down, up) Impairment pair described by add_impairment_args() options."""
+    def impairment(active, seed):
+        if not active:
+            return Impairment(seed=seed)
+        return Impairment(loss=args.loss / 100, delay=args.delay / 1000, jitter=args.jitter / 1000,
+                          reorder=args.reorder / 100, reorder_delay=args.reorder_delay / 1000,
+                          rate_bps=args.rate * 1_000_000, queue_limit=args.queue_limit / 1000, seed=seed)
+    return (impairment(args.direction in ('down', 'both'), args.seed),
+            impairment(args.direction in ('up', 'both'), args.seed + 1))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Impairing UDP/TCP proxy for the speed test")
+    parser.add_argument('--server', default='127.0.0.1', help="server IP address")
+    parser.add_argument('--server-udp-port', type=int, default=DEFAULT_SERVER_UDP_PORT)
+    parser.add_argument('--server-tcp-port', type=int, default=DEFAULT_TCP_PORT)
+    parser.add_argument('--udp-port', type=int, default=DEFAULT_PROXY_UDP_PORT, help="UDP port clients use")
+    parser.add_argument('--tcp-port', type=int, default=DEFAULT_PROXY_TCP_PORT, help="TCP port clients use")
+    add_impairment_args(parser)
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    down, up = impairments_from_args(args)
+    proxy = ImpairmentProxy(args.server, args.server_udp_port, args.server_tcp_port,
+                            args.udp_port, args.tcp_port, down, up)
+    asyncio.run(proxy.run())
+
+if __name__ == "__main__":
+    main()
@@ -1,142 +1,247 @@
+import argparse
 import socket
-import struct
-import time
 from tqdm import tqdm
 from threading import Thread
 import sys
 import os
-from collections import defaultdict
 import threading
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../')))
 from Shared.shared import *
-
-
-def listen_for_offers():
-    """Listen for server offers via UDP."""
-    udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    udp_socket.bind(('', DEFAULT_UDP_PORT))
-
-    print(f"{bcolors.OKCYAN}Listening for server offers...{bcolors.ENDC}")
-    while True:
-        try:
-            data, addr = udp_socket.recvfrom(BUFFER_SIZE)
-            magic_cookie, message_type, udp_port, tcp_port = struct.unpack(OFFER_FORMAT, data)
-            if magic_cookie == MAGIC_COOKIE and message_type == MESSAGE_TYPE_OFFER:
-                print(f"{bcolors.OKGREEN}Offer received from {addr[0]}: UDP Port {udp_port}, TCP Port {tcp_port}{bcolors.ENDC}")
-                return addr[0], udp_port, tcp_port
-        except Exception as e:
-            print(f"{bcolors.FAIL}Error listening for offers: {e}{bcolors.ENDC}")
-
-def perform_tcp_connection(server_ip, tcp_port, file_size, connection_id, stats):
-    """Perform a TCP file transfer."""
+from Client.udp_receiver import UdpReceiver, build_udp_request, path_datagram_size
+from Client.read_buffer import ReadBuffer
+from Client.reporting import fail, finish_tcp, finish_udp
+from Client.striping import open_output, split_stripes, report_stripes
+from Client.process_pool import run_process_pool
+from Client.metrics import Metrics, DEFAULT_RESOLUTION, serve_prometheus
+from Client.session import run_tcp_trials, run_udp_trials
+from Client.discovery import ServerCache, ServerInfo, DISCOVERY_WINDOW, DEFAULT_CACHE_PATH, assign, discover, server_label
+
+
+def parse_server(value):
+    """Parse --server HOST[:UDP_PORT[:TCP_PORT]] into the (ip, udp_port, tcp_port) of an offer."""
+    host, _, ports = value.partition(':')
+    udp_port, _, tcp_port = ports.partition(':')
+    return (host, int(udp_port) if udp_port else DEFAULT_SERVER_UDP_PORT,
+            int(tcp_port) if tcp_port else DEFAULT_TCP_PORT)
+
+def perform_tcp_connection(server, file_size, connection_id, metrics, stripe=None):
+    """Perform a TCP file transfer, or fetch one stripe of it into the output region."""
+    server_ip, _, tcp_port = server
+    counter = metrics.counter('TCP', connection_id, server_label(server))
     try:
-        start_time = time.time()
+        length = stripe.length if stripe else file_size
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as tcp_socket:
             tcp_socket.connect((server_ip, tcp_port))
-            tcp_socket.sendall(f"{file_size}\n".encode('utf-8'))
+            request = stripe.request_line(file_size) if stripe else f"{file_size}\n"
+            tcp_socket.sendall(request.encode('utf-8'))
 
+            buffer = ReadBuffer(tcp_socket)
             received = 0
-            progress = tqdm(total=file_size, unit='B', unit_scale=True, desc=f"TCP {connection_id}{bcolors.ENDC}")
-            while received < file_size:
-                data = tcp_socket.recv(BUFFER_SIZE)
-                received += len(data)
-                progress.update(len(data))
-                stats['total_bytes'] += len(data)
+            progress = tqdm(total=length, unit='B', unit_scale=True, desc=f"TCP {connection_id}{bcolors.ENDC}")
+            while received < length:
+                target = stripe.view[received:received + buffer.size] if stripe else buffer.target(length - received)
+                size = tcp_socket.recv_into(target)
+                if not size:
+                    raise ConnectionError(f"server closed the connection after {received} bytes")
+                buffer.update(size)
+                received += size
+                progress.update(size)
+                counter.add(size)
             progress.close()
-
-        elapsed_time = time.time() - start_time
-        stats['elapsed_time'] += elapsed_time
-        speed = (file_size * 8) / elapsed_time
-        print(f"{bcolors.OKGREEN}TCP {connection_id} Complete: Time: {elapsed_time:.2f}s, Speed: {speed:.2f} bits/s{bcolors.ENDC}")
+        finish_tcp(counter, length, buffer, stripe)
     except Exception as e:
-        print(f"{bcolors.FAIL}Error during TCP {connection_id}: {e}{bcolors.ENDC}")
+        fail(counter, e)
+    metrics.record(counter.as_dict())
 
-def perform_udp_connection(server_ip, udp_port, file_size, connection_id, stats):
-    """Perform a UDP file transfer."""
-    udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    udp_socket.settimeout(UDP_TIMEOUT)
-
-    request_packet = struct.pack(REQUEST_FORMAT, MAGIC_COOKIE, MESSAGE_TYPE_REQUEST, file_size)
-    udp_socket.sendto(request_packet, (server_ip, udp_port))
-
-    received_segments = 0
-    total_segments = (file_size + BUFFER_SIZE - 21 -  1) // (BUFFER_SIZE-21)
-    missing_segments = set(range(total_segments))
-    start_time = time.time()
-
-    progress = tqdm(total=file_size, unit='B', unit_scale=True, desc=f"UDP {connection_id}{bcolors.ENDC}")
-    while True:
-        try:
-            data, _ = udp_socket.recvfrom(BUFFER_SIZE)
-            header = data[:21]
-            payload = data[21:]
-
-            magic_cookie, message_type, total_segments, segment_number = struct.unpack(PAYLOAD_FORMAT, header)
-            if magic_cookie == MAGIC_COOKIE and message_type == MESSAGE_TYPE_PAYLOAD:
-                if segment_number in missing_segments:
-                    received_segments += 1
-                    missing_segments.remove(segment_number)
-                progress.update(len(payload) )
-                stats['total_bytes'] += len(payload)
-        except socket.timeout:
-            break
+def perform_udp_connection(server, file_size, connection_id, metrics, reliable=False, stripe=None, timestamps=False,
+                           datagram_size=None):
+    """Perform a UDP file transfer, or fetch one stripe of it into the output region.
 
+    datagram_size defaults to the largest the path to the server carries unfragmented.
+    """
+    server_ip, udp_port, _ = server
+    counter = metrics.counter('UDP', connection_id, server_label(server))
+    udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    datagram_size = datagram_size or path_datagram_size((server_ip, udp_port))
+    request_packet = build_udp_request(file_size, stripe, reliable, timestamps, datagram_size)
+    length = stripe.length if stripe else file_size
+
+    progress = tqdm(total=length, unit='B', unit_scale=True, desc=f"UDP {connection_id}{bcolors.ENDC}")
+    receiver = UdpReceiver(udp_socket, length, progress, counter, reliable, output=stripe.view if stripe else None,
+                           timestamps=timestamps, datagram_size=datagram_size)
+    receiver.run(request_packet, (server_ip, udp_port))
     progress.close()
-
-    elapsed_time = time.time() - start_time
-    stats['elapsed_time'] += elapsed_time
-    success_rate = (received_segments / total_segments) * 100 if total_segments else 0
-    speed = (received_segments * (BUFFER_SIZE -21) * 8) / elapsed_time
-    print(f"{bcolors.OKBLUE}UDP {connection_id} Complete: Time: {elapsed_time:.2f}s, Speed: {speed:.2f} bits/s, Success Rate: {success_rate:.2f}%{bcolors.ENDC}")
-
-def monitor_stats(stats, active_transfers):
-    """Continuously display real-time stats."""
-    while active_transfers.is_set():
-        speed = (stats['total_bytes'] * 8) / max(1, stats['elapsed_time'])
-        print(f"{bcolors.OKGREEN}Real-Time Stats: Speed: {speed:.2f} bits/s, Bytes Transferred: {stats['total_bytes']}{bcolors.ENDC}", end="\r")
-        time.sleep(1)
+    udp_socket.close()
+
+    finish_udp(counter, receiver, datagram_size, stripe)
+    metrics.record(counter.as_dict())
+
+def monitor_stats(metrics, stop):
+    """Continuously display real-time stats, one throughput sample per interval, until stop is set."""
+    while not stop.wait(metrics.resolution):
+        speed = metrics.sample()
+        print(f"{bcolors.OKGREEN}Real-Time Stats: Speed: {speed:.2f} bits/s, Bytes Transferred: {metrics.last_total}{bcolors.ENDC}", end="\r")
+
+def print_summary(summary):
+    """Print the end-of-run throughput and interval percentiles."""
+    print(f"{bcolors.OKGREEN}Run Summary: Time: {summary['elapsed']:.2f}s, Bytes: {summary['total_bytes']}, "
+          f"Speed: {summary['bits_per_second']:.2f} bits/s, Interval Speed p50/p95/p99: "
+          f"{summary['p50_bits_per_second']:.2f}/{summary['p95_bits_per_second']:.2f}/"
+          f"{summary['p99_bits_per_second']:.2f} bits/s{bcolors.ENDC}")
+
+def print_server_totals(results):
+    """Print the bytes and speed each server delivered, when connections were spread over several."""
+    servers = {}
+    for result in results:
+        servers.setdefault(result['server'], []).append(result)
+    if len(servers) < 2:
+        return
+    for server, connections in sorted(servers.items()):
+        received = sum(result.get('unique_bytes', result['bytes']) for result in connections)
+        finished = [result for result in connections if result['end_time'] is not None]
+        elapsed = (max(result['end_time'] for result in finished) - min(result['start_time'] for result in finished)
+                   if finished else 0)
+        print(f"{bcolors.OKCYAN}Server {server}: Connections: {len(connections)}, Bytes: {received}, "
+              f"Speed: {(received * 8) / max(elapsed, 1e-9):.2f} bits/s{bcolors.ENDC}")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Network speed test client")
+    parser.add_argument('--server', type=parse_server, action='append', metavar='HOST[:UDP_PORT[:TCP_PORT]]',
+                        help="use this server instead of discovering servers (repeat for several)")
+    parser.add_argument('--spread', type=int, default=1,
+                        help="spread connections round-robin over the N best servers (default: best server only)")
+    parser.add_argument('--discovery-window', type=float, default=DISCOVERY_WINDOW,
+                        help="seconds to collect server offers for")
+    parser.add_argument('--server-cache', default=DEFAULT_CACHE_PATH, help="file known servers are cached in")
+    parser.add_argument('--rediscover', action='store_true',
+                        help="listen for offers even if cached servers still answer")
+    parser.add_argument('--trials', type=int, default=1,
+                        help="transfers of the file size per connection, reporting first-trial and repeat latency")
+    parser.add_argument('--session', action='store_true',
+                        help="run trials over one persistent TCP session / UDP socket per connection "
+                             "(default: a new connection per trial)")
+    parser.add_argument('--pipeline', type=int, default=1,
+                        help="requests a TCP session keeps outstanding")
+    parser.add_argument('--file-size', type=int, help="file size in bytes (default: prompt)")
+    parser.add_argument('--tcp', type=int, help="number of TCP connections (default: prompt)")
+    parser.add_argument('--udp', type=int, help="number of UDP connections (default: prompt)")
+    parser.add_argument('--reliable', action='store_true',
+                        help="retransmit lost UDP segments (selective repeat) until the transfer completes")
+    parser.add_argument('--timestamps', action='store_true',
+                        help="timestamp UDP payloads and probe RTT to report jitter and one-way delay variation")
+    parser.add_argument('--datagram-size', type=int,
+                        help="UDP payload bytes per datagram the server sends (default: the largest the path MTU "
+                             f"carries unfragmented; {BUFFER_SIZE} keeps requests older servers understand)")
+    parser.add_argument('--striped', action='store_true',
+                        help="split one file across all TCP and UDP connections instead of downloading it once per connection")
+    parser.add_argument('--output', help="file to reassemble a striped download into (default: anonymous memory)")
+    parser.add_argument('--processes', type=int, default=0,
+                        help="shard connections across this many worker processes, each running an asyncio loop "
+                             "(default: one thread per connection in this process)")
+    parser.add_argument('--interval', type=float, default=DEFAULT_RESOLUTION,
+                        help="seconds per throughput sample")
+    parser.add_argument('--metrics-jsonl', help="append interval samples, per-connection results and the summary "
+                                                "to this file as JSON lines")
+    parser.add_argument('--prometheus-port', type=int, help="serve Prometheus metrics on 127.0.0.1:PORT/metrics")
+    args = parser.parse_args()
+    if args.trials < 1 or args.pipeline < 1:
+        parser.error("--trials and --pipeline must be at least 1")
+    if (args.trials > 1 or args.session) and (args.striped or args.processes):
+        parser.error("--trials and --session cannot be combined with --striped or --processes")
+    if args.datagram_size is not None and not MIN_DATAGRAM_SIZE <= args.datagram_size <= MAX_DATAGRAM_SIZE:
+        parser.error(f"--datagram-size must be between {MIN_DATAGRAM_SIZE} and {MAX_DATAGRAM_SIZE}")
+    return args
 
 def main():
-    server_ip, udp_port, tcp_port = listen_for_offers()
-
-    # Prompt user for details
-    file_size = int(input(f"{bcolors.HEADER}Enter file size (bytes): {bcolors.ENDC}"))
-    tcp_connections = int(input(f"{bcolors.HEADER}Enter number of TCP connections: {bcolors.ENDC}"))
-    udp_connections = int(input(f"{bcolors.HEADER}Enter number of UDP connections: {bcolors.ENDC}"))
-
-    # Shared stats for monitoring
-    stats = {'total_bytes': 0, 'elapsed_time': 0}
-    active_transfers = threading.Event()
-    active_transfers.set()
+    args = parse_args()
+    if args.server:
+        servers = [ServerInfo(*server) for server in args.server]
+    else:
+        servers = discover(ServerCache(args.server_cache), args.discovery_window, args.rediscover)
+
+    # Prompt user for details not given on the command line
+    file_size = args.file_size
+    if file_size is None:
+        file_size = int(input(f"{bcolors.HEADER}Enter file size (bytes): {bcolors.ENDC}"))
+    tcp_connections = args.tcp
+    if tcp_connections is None:
+        tcp_connections = int(input(f"{bcolors.HEADER}Enter number of TCP connections: {bcolors.ENDC}"))
+    udp_connections = args.udp
+    if udp_connections is None:
+        udp_connections = int(input(f"{bcolors.HEADER}Enter number of UDP connections: {bcolors.ENDC}"))
+
+    # In striped mode every connection fetches its own stripe of one shared file.
+    # Everything that can fail on bad input happens before the monitor thread starts.
+    stripes = [None] * (tcp_connections + udp_connections)
+    if args.striped:
+        region = open_output(file_size, args.output)
+        stripes = split_stripes(file_size, tcp_connections + udp_connections, region)
+        tcp_connections = min(tcp_connections, len(stripes))
+        udp_connections = len(stripes) - tcp_connections
+
+    tcp_servers = [server.address for server in assign(servers, tcp_connections, args.spread)]
+    udp_servers = [server.address for server in assign(servers, udp_connections, args.spread)]
+
+    # Per-connection counters, merged by the monitor thread
+    metrics = Metrics(args.interval, args.metrics_jsonl)
+    if args.prometheus_port:
+        serve_prometheus(metrics, args.prometheus_port)
+    stop_monitor = threading.Event()
 
     # Start real-time monitoring
-    monitor_thread = threading.Thread(target=monitor_stats, args=(stats, active_transfers))
+    monitor_thread = threading.Thread(target=monitor_stats, args=(metrics, stop_monitor))
     monitor_thread.start()
 
     # Perform TCP and UDP connections
     threads = []
 
-    # Start TCP connections
-    for i in range(tcp_connections):
-        thread = Thread(target=perform_tcp_connection, args=(server_ip, tcp_port, file_size, i + 1, stats))
-        thread.start()
-        threads.append(thread)
-
-    # Start UDP connections
-    for i in range(udp_connections):
-        thread = Thread(target=perform_udp_connection, args=(server_ip, udp_port, file_size, i + 1, stats))
-        thread.start()
-        threads.append(thread)
-
-    # Wait for all threads to complete
-    for thread in threads:
-        thread.join()
+    if args.trials > 1 or args.session:
+        # Repeated trials per connection, warm over sessions or cold
+        for i in range(tcp_connections):
+            thread = Thread(target=run_tcp_trials,
+                            args=(tcp_servers[i], file_size, i + 1, metrics, args.trials, args.pipeline, args.session))
+            thread.start()
+            threads.append(thread)
+        for i in range(udp_connections):
+            thread = Thread(target=run_udp_trials,
+                            args=(udp_servers[i], file_size, i + 1, metrics, args.trials, args.reliable,
+                                  args.timestamps, args.session, args.datagram_size))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+    elif args.processes:
+        run_process_pool(tcp_servers, udp_servers, file_size, args.processes, metrics,
+                         args.reliable, stripes, args.timestamps, args.datagram_size)
+    else:
+        # Start TCP connections
+        for i in range(tcp_connections):
+            thread = Thread(target=perform_tcp_connection, args=(tcp_servers[i], file_size, i + 1, metrics, stripes[i]))
+            thread.start()
+            threads.append(thread)
+
+        # Start UDP connections
+        for i in range(udp_connections):
+            thread = Thread(target=perform_udp_connection,
+                            args=(udp_servers[i], file_size, i + 1, metrics, args.reliable, stripes[tcp_connections + i],
+                                  args.timestamps, args.datagram_size))
+            thread.start()
+            threads.append(thread)
+
+        # Wait for all threads to complete
+        for thread in threads:
+            thread.join()
 
     # Stop monitoring
-    active_transfers.clear()
+    stop_monitor.set()
     monitor_thread.join()
+    print()
+    print_summary(metrics.finish())
+    print_server_totals(metrics.results)
+
+    if args.striped:
+        report_stripes(stripes, file_size)
 
     print(f"{bcolors.OKGREEN}All transfers complete.{bcolors.ENDC}")
 
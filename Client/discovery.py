@@ -0,0 +1,220 @@
+import json
+import os
+import socket
+import time
+
+from Shared.shared import *
+
+DISCOVERY_WINDOW = 1.5      # Seconds offers are collected for; servers offer once per OFFER_INTERVAL
+SERVER_TTL = 60             # Seconds a server stays cached after its last offer or probe answer
+PROBE_COUNT = 3             # PINGs per server; the smallest RTT is kept
+PROBE_TIMEOUT = 0.5         # Seconds to wait for PONGs
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'speedtest_servers.json')
+
+
+def server_label(server):
+    """Render an (ip, udp_port, tcp_port) address the way --server accepts it."""
+    return ':'.join(str(part) for part in server)
+
+
+class ServerInfo:
+    """A known server, with the RTT and load reported by its last probe."""
+
+    def __init__(self, ip, udp_port, tcp_port, last_seen=None, rtt=None, active=None, capacity=None):
+        self.ip = ip
+        self.udp_port = udp_port
+        self.tcp_port = tcp_port
+        self.last_seen = last_seen if last_seen is not None else time.time()
+        self.rtt = rtt                  # Seconds, None if the server did not answer the probe
+        self.active = active            # Transfers in progress, from the PONG
+        self.capacity = capacity        # Transfers admitted at most, from the PONG
+
+    @property
+    def address(self):
+        """The (ip, udp_port, tcp_port) tuple connections are made to, as from an offer."""
+        return self.ip, self.udp_port, self.tcp_port
+
+    def load(self):
+        return self.active / self.capacity if self.capacity else 0.0
+
+    def full(self):
+        return bool(self.capacity) and self.active >= self.capacity
+
+    def describe(self):
+        rtt = f"RTT {self.rtt * 1000:.3f}ms" if self.rtt is not None else "no probe answer"
+        load = f", load {self.active}/{self.capacity}" if self.capacity else ""
+        return f"{self.ip} (UDP {self.udp_port}, TCP {self.tcp_port}): {rtt}{load}"
+
+    def as_dict(self):
+        return {'ip': self.ip, 'udp_port': self.udp_port, 'tcp_port': self.tcp_port, 'last_seen': self.last_seen,
+                'rtt': self.rtt, 'active': self.active, 'capacity': self.capacity}
+
+
+class ServerCache:
+    """Servers seen within the last ttl seconds, kept in a JSON file across runs."""
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, ttl=SERVER_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.entries = {}
+        try:
+            with open(path) as cache_file:
+                for entry in json.load(cache_file):
+                    server = ServerInfo(**entry)
+                    self.entries[server.address] = server
+        except (OSError, ValueError, TypeError):
+            pass    # A missing or corrupt cache only costs a discovery window
+
+    def add(self, ip, udp_port, tcp_port):
+        """Record an offer, returning the server's entry."""
+        server = self.entries.get((ip, udp_port, tcp_port))
+        if server is None:
+            server = self.entries[ip, udp_port, tcp_port] = ServerInfo(ip, udp_port, tcp_port)
+        server.last_seen = time.time()
+        return server
+
+    def remove(self, server):
+        self.entries.pop(server.address, None)
+
+    def servers(self):
+        """Unexpired servers."""
+        deadline = time.time() - self.ttl
+        for address, server in list(self.entries.items()):
+            if server.last_seen < deadline:
+                del self.entries[address]
+        return list(self.entries.values())
+
+    def save(self):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            temporary = f"{self.path}.{os.getpid()}"
+            with open(temporary, 'w') as cache_file:
+                json.dump([server.as_dict() for server in self.servers()], cache_file)
+            os.replace(temporary, self.path)
+        except OSError as e:
+            print(f"{bcolors.WARNING}Could not save the server cache: {e}{bcolors.ENDC}")
+
+
+def collect_offers(cache, window=DISCOVERY_WINDOW):
+    """Add every server offering within window seconds to cache and return the addresses heard.
+
+    If neither an offer nor a cached server turns up in the window, keep waiting
+    for the first offer, as a single-server client always did.
+    """
+    heard = set()
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as udp_socket:
+        udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        udp_socket.bind(('', DEFAULT_UDP_PORT))
+        print(f"{bcolors.OKCYAN}Listening for server offers...{bcolors.ENDC}")
+        deadline = time.monotonic() + window
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                if heard or cache.servers():
+                    break
+                remaining = None
+            udp_socket.settimeout(remaining)
+            try:
+                data, addr = udp_socket.recvfrom(BUFFER_SIZE)
+            except socket.timeout:
+                continue
+            if len(data) < OFFER_STRUCT.size:
+                continue
+            magic_cookie, message_type, udp_port, tcp_port = OFFER_STRUCT.unpack_from(data)
+            if magic_cookie == MAGIC_COOKIE and message_type == MESSAGE_TYPE_OFFER:
+                if (addr[0], udp_port, tcp_port) not in heard:
+                    print(f"{bcolors.OKGREEN}Offer received from {addr[0]}: UDP Port {udp_port}, TCP Port {tcp_port}{bcolors.ENDC}")
+                heard.add(cache.add(addr[0], udp_port, tcp_port).address)
+    return heard
+
+
+def probe(servers, count=PROBE_COUNT, timeout=PROBE_TIMEOUT):
+    """Measure each server's RTT with PINGs to its UDP port, and read the load its PONGs report.
+
+    Servers that predate PING never answer; their rtt stays None.
+    """
+    by_address = {(server.ip, server.udp_port): server for server in servers}
+    for server in servers:
+        server.rtt = None
+    if not servers:
+        return servers
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as udp_socket:
+        for _ in range(count):
+            for server in servers:
+                udp_socket.sendto(PING_STRUCT.pack(MAGIC_COOKIE, MESSAGE_TYPE_PING, time.monotonic_ns()),
+                                  (server.ip, server.udp_port))
+        answers = 0
+        deadline = time.monotonic() + timeout
+        while answers < count * len(servers):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            udp_socket.settimeout(remaining)
+            try:
+                data, addr = udp_socket.recvfrom(BUFFER_SIZE)
+            except socket.timeout:
+                break
+            except ConnectionError:
+                continue    # ICMP port unreachable from a server that went away
+            server = by_address.get(addr)
+            if server is None or len(data) < PING_STRUCT.size:
+                continue
+            magic_cookie, message_type, sent_ns = PING_STRUCT.unpack_from(data)
+            if magic_cookie != MAGIC_COOKIE or message_type != MESSAGE_TYPE_PONG:
+                continue
+            answers += 1
+            rtt = (time.monotonic_ns() - sent_ns) / 1e9
+            server.rtt = rtt if server.rtt is None else min(server.rtt, rtt)
+            server.last_seen = time.time()
+            if len(data) >= PONG_STRUCT.size:
+                _, _, _, server.active, server.capacity = PONG_STRUCT.unpack_from(data)
+    return servers
+
+
+def rank(servers):
+    """Best server first: answered the probe, has free capacity, then lowest RTT scaled by load."""
+    return sorted(servers, key=lambda server: (server.rtt is None, server.full(),
+                                               (server.rtt or 0) * (1 + server.load())))
+
+
+def discover(cache, window=DISCOVERY_WINDOW, rediscover=False):
+    """Return the known servers best first.
+
+    Cached servers that still answer a probe are used without waiting for
+    offers, unless rediscover is set. Otherwise offers are collected and every
+    known server is probed; cached servers that were not heard in this window
+    and do not answer the probe are forgotten. If that leaves no server, offers
+    are awaited again, so at least one server is always returned.
+    """
+    if not rediscover:
+        alive = [server for server in probe(cache.servers()) if server.rtt is not None]
+        if alive:
+            cache.save()
+            servers = rank(alive)
+            for server in servers:
+                print(f"{bcolors.OKCYAN}Cached server {server.describe()}{bcolors.ENDC}")
+            return servers
+
+    while True:
+        heard = collect_offers(cache, window)
+        servers = probe(cache.servers())
+        for server in servers:
+            if server.rtt is None and server.address not in heard:
+                cache.remove(server)
+        if cache.servers():
+            break
+        # Only dead cached servers cut the window short; wait for a real offer
+        print(f"{bcolors.WARNING}No cached server answered, waiting for offers{bcolors.ENDC}")
+    cache.save()
+    servers = rank(cache.servers())
+    for server in servers:
+        print(f"{bcolors.OKCYAN}Server {server.describe()}{bcolors.ENDC}")
+    return servers
+
+
+def assign(servers, count, spread=1):
+    """Pick the server of each of count connections, round-robin over the best spread servers."""
+    if not servers:
+        raise ValueError("no servers to assign connections to")
+    chosen = [server for server in servers if not server.full()][:max(1, spread)] or servers[:1]
+    return [chosen[index % len(chosen)] for index in range(count)]
@@ -0,0 +1,106 @@
+NS_PER_MS = 1_000_000
+
+
+class DelayStats:
+    """Per-stream delay, jitter, reordering and duplicate statistics in O(1) memory.
+
+    Transit time is arrival minus send timestamp. Across hosts the two monotonic
+    clocks have an unknown offset, so only differences of transit times are
+    meaningful: one-way delay variation is reported relative to the smallest
+    transit seen, and jitter is the RFC 3550 interarrival estimate
+    J += (|D| - J) / 16, where D is the change in transit between consecutive
+    packets.
+    """
+
+    def __init__(self):
+        self.packets = 0
+        self.jitter = 0.0
+        self.previous_transit = None
+        self.min_transit = None
+        self.max_transit = None
+        self.transit_sum = 0
+
+        self.highest_segment = -1
+        self.reordered = 0
+        self.max_reorder_depth = 0
+        self.duplicates = 0
+
+    def on_segment(self, segment_number, new, repair=False):
+        """Account for reordering and duplicates of any payload packet.
+
+        Segments arriving during a repair round are retransmissions, which are
+        late by design and not counted as reordered.
+        """
+        if not new:
+            self.duplicates += 1
+        if segment_number > self.highest_segment:
+            self.highest_segment = segment_number
+        elif new and not repair:
+            self.reordered += 1
+            depth = self.highest_segment - segment_number
+            if depth > self.max_reorder_depth:
+                self.max_reorder_depth = depth
+
+    def on_timestamp(self, sent_ns, arrival_ns):
+        """Account for one timestamped packet."""
+        transit = arrival_ns - sent_ns
+        if self.previous_transit is not None:
+            self.jitter += (abs(transit - self.previous_transit) - self.jitter) / 16
+        self.previous_transit = transit
+        if self.min_transit is None or transit < self.min_transit:
+            self.min_transit = transit
+        if self.max_transit is None or transit > self.max_transit:
+            self.max_transit = transit
+        self.transit_sum += transit
+        self.packets += 1
+
+    def summary(self):
+        """Delay metrics in milliseconds plus reordering and duplicate counts."""
+        summary = {'reordered': self.reordered, 'max_reorder_depth': self.max_reorder_depth,
+                   'duplicates': self.duplicates}
+        if self.packets:
+            mean_transit = self.transit_sum / self.packets
+            summary.update({
+                'jitter_ms': self.jitter / NS_PER_MS,
+                'owd_variation_avg_ms': (mean_transit - self.min_transit) / NS_PER_MS,
+                'owd_variation_max_ms': (self.max_transit - self.min_transit) / NS_PER_MS,
+            })
+        return summary
+
+
+class RttStats:
+    """Min/avg/max of the round-trip times measured by PING/PONG probes."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def add(self, rtt_ns):
+        self.count += 1
+        self.total += rtt_ns
+        if self.min is None or rtt_ns < self.min:
+            self.min = rtt_ns
+        if self.max is None or rtt_ns > self.max:
+            self.max = rtt_ns
+
+    def summary(self):
+        if not self.count:
+            return {}
+        return {'rtt_min_ms': self.min / NS_PER_MS, 'rtt_avg_ms': self.total / self.count / NS_PER_MS,
+                'rtt_max_ms': self.max / NS_PER_MS, 'rtt_probes': self.count}
+
+
+def format_delay(summary):
+    """One-line rendering of DelayStats/RttStats summaries for the console."""
+    parts = []
+    if 'jitter_ms' in summary:
+        parts.append(f"Jitter: {summary['jitter_ms']:.3f}ms, OWD Variation avg/max: "
+                     f"{summary['owd_variation_avg_ms']:.3f}/{summary['owd_variation_max_ms']:.3f}ms")
+    if 'rtt_avg_ms' in summary:
+        parts.append(f"RTT min/avg/max: {summary['rtt_min_ms']:.3f}/{summary['rtt_avg_ms']:.3f}/"
+                     f"{summary['rtt_max_ms']:.3f}ms")
+    parts.append(f"Reordered: {summary['reordered']} (max depth {summary['max_reorder_depth']}), "
+                 f"Duplicates: {summary['duplicates']}")
+    return ", ".join(parts)
@@ -0,0 +1,203 @@
+import json
+import math
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_RESOLUTION = 1.0        # Seconds per throughput sample
+PERCENTILES = (50, 95, 99)
+
+
+class ConnectionCounter:
+    """Byte counter of one connection.
+
+    Only the thread (or event loop) running the connection writes to it; the
+    monitor merely reads ``bytes``, so no lock is needed.
+    """
+
+    def __init__(self, kind, connection_id, server=None):
+        self.kind = kind
+        self.id = connection_id
+        self.server = server
+        self.bytes = 0
+        self.start_time = time.time()
+        self.end_time = None
+        self.details = {}
+
+    def add(self, nbytes):
+        self.bytes += nbytes
+
+    def finish(self, **details):
+        """Mark the connection complete, keeping extra results such as the UDP success rate."""
+        self.end_time = time.time()
+        self.details.update(details)
+
+    def as_dict(self):
+        return {'kind': self.kind, 'id': self.id, 'server': self.server, 'bytes': self.bytes,
+                'start_time': self.start_time, 'end_time': self.end_time, **self.details}
+
+
+class SharedCounter:
+    """Read-only view of a byte counter a worker process publishes in a shared array slot."""
+
+    def __init__(self, kind, connection_id, array, slot):
+        self.kind = kind
+        self.id = connection_id
+        self.array = array
+        self.slot = slot
+        self.end_time = None
+
+    @property
+    def bytes(self):
+        return self.array[self.slot]
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile of a list of numbers."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(percent / 100 * len(ordered)) - 1)]
+
+
+class Metrics:
+    """Merges per-connection counters into an interval throughput time series.
+
+    The monitor thread calls sample() every ``resolution`` seconds; each sample
+    is the bytes moved during that interval divided by its measured length, so
+    the live speed is meaningful while transfers run. finish() closes the last,
+    usually partial, interval when the last connection ended, and the summary
+    covers the run up to that point only. Samples, per-connection
+    results and the final summary can be streamed as JSON lines, and the current
+    state is available in Prometheus text format.
+    """
+
+    def __init__(self, resolution=DEFAULT_RESOLUTION, jsonl_path=None):
+        self.resolution = resolution
+        self.counters = []
+        self.results = []
+        self.samples = []   # (seconds since start, interval bytes, bits/s)
+        self.start = time.monotonic()
+        self.start_wall = time.time()   # Counters stamp their end_time with time.time()
+        self.last_time = self.start
+        self.last_total = 0
+        self.jsonl = open(jsonl_path, 'a') if jsonl_path else None
+
+    def counter(self, kind, connection_id, server=None):
+        """Create and register the counter of a new connection."""
+        return self.register(ConnectionCounter(kind, connection_id, server))
+
+    def register(self, counter):
+        # list.append is atomic; the monitor iterates over a snapshot
+        self.counters.append(counter)
+        return counter
+
+    def total_bytes(self):
+        return sum(counter.bytes for counter in list(self.counters))
+
+    def active_connections(self):
+        return sum(1 for counter in list(self.counters) if counter.end_time is None)
+
+    def end_time(self):
+        """Monotonic time the last finished connection ended, or None if none has."""
+        ends = [counter.end_time for counter in list(self.counters) if counter.end_time is not None]
+        return self.start + (max(ends) - self.start_wall) if ends else None
+
+    def sample(self):
+        """Close the current interval and return its throughput in bits/s."""
+        now = time.monotonic()
+        if self.counters and not self.active_connections():
+            # Once everything finished, the interval ends with the last connection, not the idle tail
+            now = min(now, self.end_time())
+        if now <= self.last_time:
+            return 0.0
+        total = self.total_bytes()
+        interval_bytes = total - self.last_total
+        speed = (interval_bytes * 8) / max(now - self.last_time, 1e-9)
+        self.samples.append((now - self.start, interval_bytes, speed))
+        self.last_time, self.last_total = now, total
+        self.emit({'type': 'interval', 'time': round(now - self.start, 6), 'bytes': interval_bytes,
+                   'bits_per_second': speed, 'total_bytes': total})
+        return speed
+
+    def record(self, result):
+        """Keep a finished connection's result dict (see ConnectionCounter.as_dict)."""
+        self.results.append(result)
+        self.emit({'type': 'connection', **result})
+
+    def summary(self):
+        speeds = [speed for _, _, speed in self.samples]
+        elapsed = self.last_time - self.start
+        summary = {'type': 'summary', 'total_bytes': self.last_total, 'elapsed': elapsed,
+                   'bits_per_second': (self.last_total * 8) / max(elapsed, 1e-9),
+                   'intervals': len(speeds), 'resolution': self.resolution}
+        for percent in PERCENTILES:
+            summary[f'p{percent}_bits_per_second'] = percentile(speeds, percent)
+        return summary
+
+    def finish(self):
+        """Take the last sample, write the summary and close the export file."""
+        # A trailing empty interval would only drag the percentiles down
+        if self.total_bytes() != self.last_total or not self.samples:
+            self.sample()
+        summary = self.summary()
+        self.emit(summary)
+        if self.jsonl:
+            self.jsonl.close()
+            self.jsonl = None
+        return summary
+
+    def emit(self, record):
+        if self.jsonl:
+            self.jsonl.write(json.dumps(record) + '\n')
+            self.jsonl.flush()
+
+    def prometheus(self):
+        """Render the current metrics in the Prometheus text exposition format."""
+        speeds = [speed for _, _, speed in self.samples]
+        lines = [
+            '# HELP speedtest_bytes_total Payload bytes received by all connections.',
+            '# TYPE speedtest_bytes_total counter',
+            f'speedtest_bytes_total {self.total_bytes()}',
+            '# HELP speedtest_throughput_bits_per_second Throughput over the last sample interval.',
+            '# TYPE speedtest_throughput_bits_per_second gauge',
+            f'speedtest_throughput_bits_per_second {speeds[-1] if speeds else 0}',
+            '# HELP speedtest_active_connections Connections still transferring.',
+            '# TYPE speedtest_active_connections gauge',
+            f'speedtest_active_connections {self.active_connections()}',
+            '# HELP speedtest_interval_throughput_bits_per_second Interval throughput percentiles for this run.',
+            '# TYPE speedtest_interval_throughput_bits_per_second summary',
+        ]
+        for percent in PERCENTILES:
+            lines.append(f'speedtest_interval_throughput_bits_per_second{{quantile="{percent / 100}"}} '
+                         f'{percentile(speeds, percent)}')
+        lines.append(f'speedtest_interval_throughput_bits_per_second_sum {sum(speeds)}')
+        lines.append(f'speedtest_interval_throughput_bits_per_second_count {len(speeds)}')
+        lines += ['# HELP speedtest_connection_bytes_total Payload bytes received per connection.',
+                  '# TYPE speedtest_connection_bytes_total counter']
+        for counter in list(self.counters):
+            lines.append(f'speedtest_connection_bytes_total{{kind="{counter.kind}",id="{counter.id}"}} {counter.bytes}')
+        return '\n'.join(lines) + '\n'
+
+
+def serve_prometheus(metrics, port):
+    """Serve metrics.prometheus() on http://127.0.0.1:port/metrics from a daemon thread."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
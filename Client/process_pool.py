@@ -0,0 +1,146 @@
+import asyncio
+import multiprocessing
+import queue
+import socket
+
+from Shared.shared import *
+from Client.udp_receiver import UdpReceiver, build_udp_request, path_datagram_size
+from Client.read_buffer import ReadBuffer
+from Client.reporting import fail, finish_tcp, finish_udp
+from Client.metrics import ConnectionCounter, SharedCounter
+from Client.discovery import server_label
+
+PUBLISH_INTERVAL = 0.1          # Seconds between a worker's shared counter updates
+POLL_INTERVAL = 0.2             # Seconds between parent checks on its workers
+
+
+async def tcp_transfer(server, file_size, counter, stripe=None):
+    """Event-loop version of perform_tcp_connection, counting into counter."""
+    loop = asyncio.get_running_loop()
+    server_ip, _, tcp_port = server
+    length = stripe.length if stripe else file_size
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as tcp_socket:
+            tcp_socket.setblocking(False)
+            await loop.sock_connect(tcp_socket, (server_ip, tcp_port))
+            request = stripe.request_line(file_size) if stripe else f"{file_size}\n"
+            await loop.sock_sendall(tcp_socket, request.encode('utf-8'))
+
+            buffer = ReadBuffer(tcp_socket)
+            received = 0
+            while received < length:
+                target = stripe.view[received:received + buffer.size] if stripe else buffer.target(length - received)
+                size = await loop.sock_recv_into(tcp_socket, target)
+                if not size:
+                    raise ConnectionError(f"server closed the connection after {received} bytes")
+                buffer.update(size)
+                received += size
+                counter.add(size)
+        finish_tcp(counter, length, buffer, stripe)
+    except Exception as e:
+        fail(counter, e)
+
+
+async def udp_transfer(server, file_size, counter, reliable=False, stripe=None, timestamps=False, datagram_size=None):
+    """Event-loop version of perform_udp_connection, counting into counter."""
+    server_ip, udp_port, _ = server
+    datagram_size = datagram_size or path_datagram_size((server_ip, udp_port))
+    request_packet = build_udp_request(file_size, stripe, reliable, timestamps, datagram_size)
+    length = stripe.length if stripe else file_size
+
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as udp_socket:
+        receiver = UdpReceiver(udp_socket, length, None, counter, reliable, output=stripe.view if stripe else None,
+                               timestamps=timestamps, datagram_size=datagram_size)
+        await receiver.run_async(request_packet, (server_ip, udp_port))
+    finish_udp(counter, receiver, datagram_size, stripe)
+
+
+async def run_shard(jobs, file_size, reliable, timestamps, datagram_size, shared_bytes):
+    """Run one worker's share of the connections on a single event loop."""
+    # Counters are only touched by this loop; the publisher copies them to shared memory
+    counters = []
+    transfers = []
+    for slot, kind, connection_id, server, stripe in jobs:
+        counter = ConnectionCounter(kind, connection_id, server_label(server))
+        counters.append((slot, counter))
+        if kind == 'TCP':
+            transfers.append(tcp_transfer(server, file_size, counter, stripe))
+        else:
+            transfers.append(udp_transfer(server, file_size, counter, reliable, stripe, timestamps, datagram_size))
+
+    def publish_once():
+        for slot, counter in counters:
+            shared_bytes[slot] = counter.bytes
+
+    async def publish():
+        while True:
+            publish_once()
+            await asyncio.sleep(PUBLISH_INTERVAL)
+
+    publisher = asyncio.create_task(publish())
+    try:
+        await asyncio.gather(*transfers)
+    finally:
+        publisher.cancel()
+        publish_once()
+    return [counter.as_dict() for _, counter in counters]
+
+
+def worker_main(jobs, file_size, reliable, timestamps, datagram_size, shared_bytes, results):
+    """Process entry point: run a shard and send its results to the parent."""
+    try:
+        results.put(asyncio.run(run_shard(jobs, file_size, reliable, timestamps, datagram_size, shared_bytes)))
+    except BaseException as e:
+        print(f"{bcolors.FAIL}Worker failed: {e}{bcolors.ENDC}")
+        results.put([])
+
+
+def run_process_pool(tcp_servers, udp_servers, file_size, processes, metrics,
+                     reliable=False, stripes=None, timestamps=False, datagram_size=None):
+    """Shard the connections round-robin across worker processes, each running an asyncio loop.
+
+    Every connection owns one slot of a shared array that only its worker writes,
+    so no locking is needed; the parent registers the slots with metrics and
+    collects every connection's result at the end. Stripes write into the shared
+    output mapping, which the forked workers inherit.
+    """
+    tcp_connections = len(tcp_servers)
+    stripes = stripes or [None] * (tcp_connections + len(udp_servers))
+    jobs = [('TCP', i + 1, server, stripes[i]) for i, server in enumerate(tcp_servers)]
+    jobs += [('UDP', i + 1, server, stripes[tcp_connections + i]) for i, server in enumerate(udp_servers)]
+    jobs = [(slot, *job) for slot, job in enumerate(jobs)]
+    processes = max(1, min(processes, len(jobs)))
+
+    # fork lets workers inherit the output mapping and the stripes' memoryviews
+    context = multiprocessing.get_context('fork')
+    shared_bytes = context.Array('Q', len(jobs), lock=False)
+    shared_counters = {(kind, connection_id): metrics.register(SharedCounter(kind, connection_id, shared_bytes, slot))
+                       for slot, kind, connection_id, _, _ in jobs}
+    results = context.Queue()
+    workers = [context.Process(target=worker_main,
+                               args=(jobs[worker::processes], file_size, reliable, timestamps, datagram_size,
+                                     shared_bytes, results))
+               for worker in range(processes)]
+    for worker in workers:
+        worker.start()
+
+    # Drain results while waiting, so workers never block on a full queue
+    pending = len(workers)
+    while pending:
+        try:
+            shard_results = results.get(timeout=POLL_INTERVAL)
+        except queue.Empty:
+            if not any(worker.is_alive() for worker in workers) and results.empty():
+                print(f"{bcolors.FAIL}{pending} worker(s) exited without results{bcolors.ENDC}")
+                break
+            continue
+        pending -= 1
+        for result in shard_results:
+            shared_counters[result['kind'], result['id']].end_time = result['end_time']
+            metrics.record(result)
+            if result.get('stripe') is not None:
+                stripe = stripes[result['stripe']]
+                stripe.start_time, stripe.end_time = result['start_time'], result['end_time']
+                stripe.bytes_received = result.get('unique_bytes', result['bytes'])
+    for worker in workers:
+        worker.join()
@@ -0,0 +1,33 @@
+import socket
+
+MIN_READ_SIZE = 16 * 1024
+MAX_READ_SIZE = 4 * 1024 * 1024
+
+
+class ReadBuffer:
+    """Scratch buffer for TCP recv_into calls, sized from the socket and the observed throughput.
+
+    Reads start at half of SO_RCVBUF (Linux reports twice the usable space)
+    and the buffer doubles, up to MAX_READ_SIZE, whenever a read comes back
+    full, i.e. data arrives faster than it is drained.
+    """
+
+    def __init__(self, sock):
+        try:
+            receive_buffer = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        except OSError:
+            receive_buffer = 0
+        self.size = max(MIN_READ_SIZE, min(MAX_READ_SIZE, receive_buffer // 2))
+        self.view = memoryview(bytearray(self.size))
+        self.reads = 0
+
+    def target(self, limit):
+        """View to read the next at most limit bytes into."""
+        return self.view[:min(self.size, limit)]
+
+    def update(self, nbytes):
+        """Account for a read of nbytes, growing the buffer after a full one."""
+        self.reads += 1
+        if nbytes == self.size and self.size < MAX_READ_SIZE:
+            self.size = min(MAX_READ_SIZE, self.size * 2)
+            self.view = memoryview(bytearray(self.size))
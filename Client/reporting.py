@@ -0,0 +1,33 @@
+from Shared.shared import *
+from Client.latency import format_delay
+
+
+def finish_tcp(counter, length, buffer, stripe=None):
+    """Record a completed TCP transfer in its counter (and stripe) and print its result."""
+    counter.finish(stripe=stripe.index if stripe else None, reads=buffer.reads, read_size=buffer.size)
+    elapsed_time = counter.end_time - counter.start_time
+    if stripe:
+        stripe.start_time, stripe.end_time, stripe.bytes_received = counter.start_time, counter.end_time, length
+    speed = (length * 8) / elapsed_time
+    print(f"{bcolors.OKGREEN}TCP {counter.id} Complete: Time: {elapsed_time:.2f}s, Speed: {speed:.2f} bits/s{bcolors.ENDC}")
+
+
+def finish_udp(counter, receiver, datagram_size, stripe=None):
+    """Record a finished UDP transfer in its counter (and stripe) and print its result."""
+    delay = receiver.delay_summary()
+    counter.finish(stripe=stripe.index if stripe else None, unique_bytes=receiver.bytes_received,
+                   datagram_size=datagram_size, success_rate=receiver.success_rate(),
+                   repair_rounds=receiver.repair_rounds, **delay)
+    elapsed_time = counter.end_time - counter.start_time
+    if stripe:
+        stripe.start_time, stripe.end_time, stripe.bytes_received = counter.start_time, counter.end_time, receiver.bytes_received
+    speed = (receiver.bytes_received * 8) / elapsed_time
+    repair = f", Repair Rounds: {receiver.repair_rounds}" if receiver.reliable else ""
+    print(f"{bcolors.OKBLUE}UDP {counter.id} Complete: Time: {elapsed_time:.2f}s, Speed: {speed:.2f} bits/s, "
+          f"Success Rate: {receiver.success_rate():.2f}%{repair}, {format_delay(delay)}{bcolors.ENDC}")
+
+
+def fail(counter, error):
+    """Record a failed transfer in its counter and print the error."""
+    counter.finish(error=str(error))
+    print(f"{bcolors.FAIL}Error during {counter.kind} {counter.id}: {error}{bcolors.ENDC}")
@@ -0,0 +1,165 @@
+import socket
+import time
+from collections import deque
+
+from Shared.shared import *
+from Client.udp_receiver import UdpReceiver, build_udp_request, path_datagram_size
+from Client.read_buffer import ReadBuffer
+from Client.metrics import percentile
+from Client.discovery import server_label
+
+
+def receive_exactly(sock, length, buffer, counter):
+    """Read one length-byte answer into buffer and drop it, counting it into counter."""
+    received = 0
+    while received < length:
+        size = sock.recv_into(buffer.target(length - received))
+        if not size:
+            raise ConnectionError(f"server closed the connection after {received} of {length} bytes")
+        buffer.update(size)
+        received += size
+        counter.add(size)
+
+
+class TcpSession:
+    """Persistent TCP connection on which sized requests are pipelined and answered in order."""
+
+    def __init__(self, server):
+        server_ip, _, tcp_port = server
+        self.socket = socket.create_connection((server_ip, tcp_port))
+        # Request lines are tiny; send each one right away
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.buffer = ReadBuffer(self.socket)
+        self.socket.sendall(SESSION_HELLO.encode('utf-8'))
+        ack = b''
+        # Nothing follows the acknowledgement until a request is sent
+        while len(ack) < len(SESSION_ACK):
+            chunk = self.socket.recv(len(SESSION_ACK) - len(ack))
+            if not chunk:
+                break
+            ack += chunk
+        if ack != SESSION_ACK.encode('utf-8'):
+            self.socket.close()
+            raise ConnectionError("server does not support sessions")
+
+    def run(self, sizes, pipeline, counter):
+        """Fetch every size with up to pipeline requests outstanding; return (sent, done) times per request."""
+        requests = iter(sizes)
+        outstanding = deque()
+        times = []
+
+        def send_next():
+            size = next(requests, None)
+            if size is not None:
+                # Stamp before sendall, which can block on a full send buffer
+                sent = time.perf_counter()
+                self.socket.sendall(f"{size}\n".encode('utf-8'))
+                outstanding.append((size, sent))
+
+        for _ in range(max(1, pipeline)):
+            send_next()
+        while outstanding:
+            size, sent = outstanding.popleft()
+            receive_exactly(self.socket, size, self.buffer, counter)
+            times.append((sent, time.perf_counter()))
+            send_next()
+        return times
+
+    def close(self):
+        self.socket.close()
+
+
+def trial_summary(times, file_size, setup=0.0):
+    """Summarize (sent, done) trial times: the first trial, which also paid setup, against the repeats."""
+    summary = {'trials': len(times)}
+    if not times:
+        return summary
+    summary['first_trial_ms'] = (times[0][1] - times[0][0] + setup) * 1000
+    repeats = times[1:]
+    if repeats:
+        latencies = [done - sent for sent, done in repeats]
+        elapsed = max(repeats[-1][1] - times[0][1], 1e-9)
+        summary.update({
+            'repeat_p50_ms': percentile(latencies, 50) * 1000,
+            'repeat_p99_ms': percentile(latencies, 99) * 1000,
+            'repeat_bits_per_second': len(repeats) * file_size * 8 / elapsed,
+        })
+    return summary
+
+
+def format_trials(summary):
+    line = f"Trials: {summary['trials']}, First: {summary.get('first_trial_ms', 0):.3f}ms"
+    if 'repeat_p50_ms' in summary:
+        line += (f", Repeats p50/p99: {summary['repeat_p50_ms']:.3f}/{summary['repeat_p99_ms']:.3f}ms, "
+                 f"Repeat Speed: {summary['repeat_bits_per_second']:.2f} bits/s")
+    return line
+
+
+def run_tcp_trials(server, file_size, connection_id, metrics, trials, pipeline=1, session=True):
+    """Fetch file_size trials times: warm over one session, or cold with a new connection per trial."""
+    counter = metrics.counter('TCP', connection_id, server_label(server))
+    try:
+        if session:
+            start = time.perf_counter()
+            tcp_session = TcpSession(server)
+            setup = time.perf_counter() - start
+            try:
+                times = tcp_session.run([file_size] * trials, pipeline, counter)
+                reads = tcp_session.buffer.reads
+            finally:
+                tcp_session.close()
+        else:
+            setup = 0.0
+            times = []
+            reads = 0
+            for _ in range(trials):
+                sent = time.perf_counter()
+                with socket.create_connection((server[0], server[2])) as tcp_socket:
+                    tcp_socket.sendall(f"{file_size}\n".encode('utf-8'))
+                    buffer = ReadBuffer(tcp_socket)
+                    receive_exactly(tcp_socket, file_size, buffer, counter)
+                    reads += buffer.reads
+                times.append((sent, time.perf_counter()))
+        summary = trial_summary(times, file_size, setup)
+        counter.finish(session=session, pipeline=pipeline, reads=reads, **summary)
+        print(f"{bcolors.OKGREEN}TCP {connection_id} Complete: {'Session' if session else 'Cold'} "
+              f"{format_trials(summary)}{bcolors.ENDC}")
+    except Exception as e:
+        counter.finish(error=str(e))
+        print(f"{bcolors.FAIL}Error during TCP {connection_id}: {e}{bcolors.ENDC}")
+    metrics.record(counter.as_dict())
+
+
+def run_udp_trials(server, file_size, connection_id, metrics, trials, reliable=False, timestamps=False, session=True,
+                   datagram_size=None):
+    """Receive file_size trials times, reusing one UDP socket (flow) across trials in session mode."""
+    counter = metrics.counter('UDP', connection_id, server_label(server))
+    udp_socket = None
+    times = []
+    success_rates = []
+    try:
+        datagram_size = datagram_size or path_datagram_size((server[0], server[1]))
+        request = build_udp_request(file_size, None, reliable, timestamps, datagram_size)
+        for _ in range(trials):
+            if udp_socket is None or not session:
+                if udp_socket is not None:
+                    udp_socket.close()
+                udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            receiver = UdpReceiver(udp_socket, file_size, None, counter, reliable, timestamps=timestamps,
+                                   datagram_size=datagram_size)
+            sent = time.perf_counter()
+            receiver.run(request, (server[0], server[1]))
+            times.append((sent, time.perf_counter()))
+            success_rates.append(receiver.success_rate())
+        summary = trial_summary(times, file_size)
+        success_rate = sum(success_rates) / len(success_rates) if success_rates else 0.0
+        counter.finish(session=session, success_rate=success_rate, datagram_size=datagram_size, **summary)
+        print(f"{bcolors.OKBLUE}UDP {connection_id} Complete: {'Session' if session else 'Cold'} "
+              f"{format_trials(summary)}, Success Rate: {success_rate:.2f}%{bcolors.ENDC}")
+    except Exception as e:
+        counter.finish(error=str(e))
+        print(f"{bcolors.FAIL}Error during UDP {connection_id}: {e}{bcolors.ENDC}")
+    finally:
+        if udp_socket is not None:
+            udp_socket.close()
+    metrics.record(counter.as_dict())
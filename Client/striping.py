@@ -0,0 +1,60 @@
+import mmap
+
+from Shared.shared import *
+
+
+class Stripe:
+    """One byte range of a striped transfer, received straight into the shared output region."""
+
+    def __init__(self, index, offset, length, region):
+        self.index = index
+        self.offset = offset
+        self.length = length
+        self.view = memoryview(region)[offset:offset + length]
+        self.start_time = None
+        self.end_time = None
+        self.bytes_received = 0
+
+    def request_line(self, file_size):
+        """TCP range request for this stripe."""
+        return TCP_RANGE_REQUEST.format(version=REQUEST_VERSION, file_size=file_size,
+                                        offset=self.offset, length=self.length)
+
+
+def open_output(file_size, path=None):
+    """Map a file_size output region, backed by path or by anonymous memory."""
+    if path is None:
+        return mmap.mmap(-1, file_size)
+    with open(path, 'w+b') as output:
+        output.truncate(file_size)
+        return mmap.mmap(output.fileno(), file_size)
+
+
+def split_stripes(file_size, count, region):
+    """Split [0, file_size) into count nearly equal stripes (fewer if the file is tiny)."""
+    count = max(1, min(count, file_size))
+    base, extra = divmod(file_size, count)
+    stripes = []
+    offset = 0
+    for index in range(count):
+        length = base + (1 if index < extra else 0)
+        stripes.append(Stripe(index, offset, length, region))
+        offset += length
+    return stripes
+
+
+def report_stripes(stripes, file_size):
+    """Print aggregate goodput and how far apart the stripes finished, like iperf -P."""
+    finished = [stripe for stripe in stripes if stripe.end_time is not None]
+    if not finished:
+        print(f"{bcolors.FAIL}Striped transfer failed: no stripe completed{bcolors.ENDC}")
+        return
+    start_time = min(stripe.start_time for stripe in finished)
+    end_time = max(stripe.end_time for stripe in finished)
+    received = sum(stripe.bytes_received for stripe in stripes)
+    goodput = (received * 8) / max(end_time - start_time, 1e-9)
+    speeds = [(stripe.bytes_received * 8) / max(stripe.end_time - stripe.start_time, 1e-9) for stripe in finished]
+    skew = end_time - min(stripe.end_time for stripe in finished)
+    print(f"{bcolors.OKGREEN}Striped Transfer Complete: Streams: {len(stripes)}, Time: {end_time - start_time:.2f}s, "
+          f"Aggregate Goodput: {goodput:.2f} bits/s, Received: {received}/{file_size} bytes, "
+          f"Stripe Skew: {skew:.2f}s (slowest {min(speeds):.2f} bits/s, fastest {max(speeds):.2f} bits/s){bcolors.ENDC}")
@@ -0,0 +1,360 @@
+import asyncio
+import re
+import socket
+import struct
+import sys
+import time
+
+from Shared.shared import *
+from Client.latency import DelayStats, RttStats
+
+RING_SLOTS = 64             # Preallocated receive buffers cycled through by recvfrom_into
+PROGRESS_EVERY = 128        # Datagrams between progress bar / byte counter updates
+NACK_DATAGRAMS = 8          # NACK packets sent per repair round at most
+DONE_REPEATS = 3            # DONE is repeated since the client stops listening after it
+UDP_RECV_BUFFER = 4 * 1024 * 1024   # Requested SO_RCVBUF, so bursts of large datagrams fit
+REPORT_TICK = min(FEEDBACK_INTERVAL, PING_INTERVAL) / 2   # Longest a due report waits between datagrams
+
+# Linux path MTU socket options, not exported by every Python version
+IP_MTU_DISCOVER = getattr(socket, 'IP_MTU_DISCOVER', 10)
+IP_PMTUDISC_DO = getattr(socket, 'IP_PMTUDISC_DO', 2)
+IP_MTU = getattr(socket, 'IP_MTU', 14)
+_MISSING_BYTES = re.compile(rb'[^\xff]+')
+
+
+class SegmentBitmap:
+    """Tracks received segments with one bit each."""
+
+    def __init__(self, total_segments):
+        self.total = total_segments
+        self.bits = bytearray((total_segments + 7) // 8)
+        self.count = 0
+        # Bits past the last segment count as received so full bytes stay 0xff
+        for segment in range(total_segments, len(self.bits) * 8):
+            self.bits[segment >> 3] |= 1 << (segment & 7)
+
+    def add(self, segment):
+        """Mark a segment received; return False if it was out of range or already seen."""
+        if segment >= self.total:
+            return False
+        mask = 1 << (segment & 7)
+        index = segment >> 3
+        if self.bits[index] & mask:
+            return False
+        self.bits[index] |= mask
+        self.count += 1
+        return True
+
+    def __contains__(self, segment):
+        return segment < self.total and bool(self.bits[segment >> 3] & (1 << (segment & 7)))
+
+    def complete(self):
+        return self.count == self.total
+
+    def missing_ranges(self, start=0, limit=None):
+        """Yield (first, count) runs of missing segments from start on, at most limit runs."""
+        runs = 0
+        first = end = None
+        # Only bytes with a clear bit are inspected; empty bytes are taken whole
+        for match in _MISSING_BYTES.finditer(self.bits, start >> 3):
+            segment = max(match.start() * 8, start)
+            while segment < match.end() * 8:
+                byte = self.bits[segment >> 3]
+                if not byte and not segment & 7:
+                    missing = 8
+                elif byte & (1 << (segment & 7)):
+                    segment += 1
+                    continue
+                else:
+                    missing = 1
+                if segment == end:
+                    end += missing
+                else:
+                    if first is not None:
+                        yield first, end - first
+                        runs += 1
+                        if runs == limit:
+                            return
+                    first, end = segment, segment + missing
+                segment += missing
+        if first is not None:
+            yield first, end - first
+
+
+class UdpReceiver:
+    """Receive engine for one UDP transfer.
+
+    Datagrams are read with recvfrom_into into a ring of preallocated buffers and
+    parsed in place through memoryviews, so no per-packet objects are created
+    beyond the header tuple. Progress and the byte counter are updated in batches.
+
+    Payload datagrams are datagram_size bytes, the size negotiated in the
+    request, so segment numbering and the success rate follow it.
+
+    With an output view (a stripe of a striped download) each new payload is
+    copied to its segment's position in that view.
+
+    In reliable mode the receiver answers every FIN, and every silent
+    RETRANSMIT_TIMEOUT after the first FIN, with NACKs built from the bitmap's
+    missing ranges, and finishes as soon as all segments are in.
+
+    Reordering and duplicates are always tracked. With timestamps the server
+    sends MESSAGE_TYPE_PAYLOAD_TS segments, whose send times feed jitter and
+    one-way delay variation, and the receiver probes RTT with PINGs. Arrival
+    times are taken when a datagram is processed, so they include the time it
+    waited in the socket buffer.
+    """
+
+    def __init__(self, udp_socket, file_size, progress=None, counter=None, reliable=False, output=None,
+                 timestamps=False, datagram_size=BUFFER_SIZE):
+        self.socket = udp_socket
+        self.file_size = file_size
+        self.timestamps = timestamps
+        self.header_size, self.segment_size = payload_layout(datagram_size, timestamps)
+        self.total_segments = (file_size + self.segment_size - 1) // self.segment_size
+        self.bitmap = SegmentBitmap(self.total_segments)
+        self.progress = progress
+        self.counter = counter
+        self.reliable = reliable
+        self.output = output
+
+        try:
+            udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDP_RECV_BUFFER)
+        except OSError:
+            pass
+        self.ring = [bytearray(max(datagram_size, BUFFER_SIZE)) for _ in range(RING_SLOTS)]
+        self.views = [memoryview(buffer) for buffer in self.ring]
+        self.slot = 0
+
+        self.bytes_received = 0
+        self.delay = DelayStats()
+        self.rtt = RttStats()
+        self.server_address = None
+        self.pending_bytes = 0
+        self.pending_packets = 0
+        self.next_feedback = time.monotonic() + FEEDBACK_INTERVAL
+        self.next_ping = time.monotonic()
+        self.round = 0
+        self.fin_seen = False
+        self.nacked_round = None
+        self.repair_rounds = 0
+        self.silence = 0
+        self.done = False
+
+    def run(self, request, request_address):
+        """Send the request, then receive until the transfer completes or the server goes silent."""
+        self.socket.settimeout(REPORT_TICK)
+        self.socket.sendto(request, request_address)
+        self.silence = 0
+        self.last_arrival = time.monotonic()
+        while not self.done:
+            view = self.views[self.slot]
+            try:
+                nbytes, address = self.socket.recvfrom_into(view)
+            except socket.timeout:
+                if not self.on_tick(request, request_address):
+                    break
+                continue
+            self.server_address = address
+            self.silence = 0
+            self.last_arrival = time.monotonic()
+            self.slot = (self.slot + 1) % RING_SLOTS
+            self.handle(view, nbytes)
+            self.report()
+        self.flush()
+
+    async def run_async(self, request, request_address):
+        """Event-loop version of run(): drain the socket each time it becomes readable."""
+        loop = asyncio.get_running_loop()
+        self.socket.setblocking(False)
+        self.socket.sendto(request, request_address)
+        self.silence = 0
+        self.last_arrival = time.monotonic()
+        readable = asyncio.Event()
+        loop.add_reader(self.socket.fileno(), readable.set)
+        try:
+            while not self.done:
+                try:
+                    await asyncio.wait_for(readable.wait(), REPORT_TICK)
+                except asyncio.TimeoutError:
+                    if not self.on_tick(request, request_address):
+                        break
+                    continue
+                readable.clear()
+                self.silence = 0
+                self.last_arrival = time.monotonic()
+                while not self.done:
+                    view = self.views[self.slot]
+                    try:
+                        nbytes, address = self.socket.recvfrom_into(view)
+                    except BlockingIOError:
+                        break
+                    self.server_address = address
+                    self.slot = (self.slot + 1) % RING_SLOTS
+                    self.handle(view, nbytes)
+                    self.report()
+        finally:
+            loop.remove_reader(self.socket.fileno())
+        self.flush()
+
+    def silence_timeout(self):
+        return RETRANSMIT_TIMEOUT if self.reliable else UDP_TIMEOUT
+
+    def on_tick(self, request, request_address):
+        """Wake-up without a datagram: send due reports, and count silence once a full timeout passed.
+
+        Return False once the transfer should end.
+        """
+        self.report()
+        now = time.monotonic()
+        if now - self.last_arrival < self.silence_timeout():
+            return True
+        self.last_arrival = now
+        return self.on_silence(request, request_address)
+
+    def on_silence(self, request, request_address):
+        """Handle a silent timeout period; return False once the transfer should end."""
+        if not self.reliable:
+            return False
+        self.silence += RETRANSMIT_TIMEOUT
+        if self.silence >= RELIABLE_TIMEOUT:
+            return False
+        if self.server_address is None:
+            self.socket.sendto(request, request_address)
+        elif self.fin_seen:
+            self.send_nacks()
+        # Before the first FIN the rest may simply not be sent yet (e.g. a paced server): keep waiting
+        return True
+
+    def handle(self, view, nbytes):
+        """Process one datagram held in view[:nbytes]."""
+        if nbytes < MESSAGE_HEADER_STRUCT.size:
+            return
+        message_type = view[4]
+        if message_type == MESSAGE_TYPE_FIN and nbytes >= FIN_STRUCT.size:
+            magic_cookie, _, _, self.round = FIN_STRUCT.unpack_from(view)
+            if magic_cookie == MAGIC_COOKIE:
+                self.fin_seen = True
+                self.send_nacks()
+            return
+        if message_type == MESSAGE_TYPE_PAYLOAD_TS and nbytes >= PAYLOAD_TS_STRUCT.size:
+            magic_cookie, _, _, segment_number, sent_ns = PAYLOAD_TS_STRUCT.unpack_from(view)
+            if magic_cookie != MAGIC_COOKIE:
+                return
+            self.delay.on_timestamp(sent_ns, time.monotonic_ns())
+        elif message_type == MESSAGE_TYPE_PAYLOAD and nbytes >= PAYLOAD_HEADER_SIZE:
+            magic_cookie, _, _, segment_number = PAYLOAD_STRUCT.unpack_from(view)
+            if magic_cookie != MAGIC_COOKIE:
+                return
+        elif message_type == MESSAGE_TYPE_PONG and nbytes >= PING_STRUCT.size:
+            magic_cookie, _, sent_ns = PING_STRUCT.unpack_from(view)
+            if magic_cookie == MAGIC_COOKIE:
+                self.rtt.add(time.monotonic_ns() - sent_ns)
+            return
+        else:
+            return
+        payload_size = nbytes - self.header_size
+        new = self.bitmap.add(segment_number)
+        if new:
+            self.bytes_received += payload_size
+            if self.output is not None:
+                start = segment_number * self.segment_size
+                self.output[start:start + payload_size] = view[self.header_size:nbytes]
+        self.delay.on_segment(segment_number, new, repair=self.repair_rounds > 0)
+        self.pending_bytes += payload_size
+        self.pending_packets += 1
+        if self.pending_packets >= PROGRESS_EVERY:
+            self.flush()
+        if self.bitmap.count == self.total_segments:
+            self.finish()
+
+    def finish(self):
+        """Stop receiving; a reliable transfer also tells the server everything arrived."""
+        if self.reliable and self.server_address is not None:
+            done = struct.pack(DONE_FORMAT, MAGIC_COOKIE, MESSAGE_TYPE_DONE, self.bitmap.count)
+            for _ in range(DONE_REPEATS):
+                self.socket.sendto(done, self.server_address)
+        self.done = True
+
+    def send_nacks(self):
+        """Report the missing segments for the current repair round."""
+        if self.bitmap.complete():
+            self.finish()
+            return
+        if self.round != self.nacked_round:
+            self.nacked_round = self.round
+            self.repair_rounds += 1
+        ranges = list(self.bitmap.missing_ranges(limit=NACK_MAX_RANGES * NACK_DATAGRAMS))
+        for index in range(0, len(ranges), NACK_MAX_RANGES):
+            self.socket.sendto(pack_nack(self.round, ranges[index:index + NACK_MAX_RANGES]), self.server_address)
+
+    def flush(self):
+        """Push batched progress to the progress bar and byte counter, and report loss to the server."""
+        if self.pending_bytes:
+            if self.progress is not None:
+                self.progress.update(self.pending_bytes)
+            if self.counter is not None:
+                self.counter.add(self.pending_bytes)
+        self.pending_bytes = 0
+        self.pending_packets = 0
+        self.report()
+
+    def report(self):
+        """Send the loss report and RTT probe if they are due; checked on every datagram and timeout."""
+        if self.server_address is None:
+            return
+        now = time.monotonic()
+        if now >= self.next_feedback:
+            feedback = struct.pack(FEEDBACK_FORMAT, MAGIC_COOKIE, MESSAGE_TYPE_FEEDBACK,
+                                   self.bitmap.count, self.delay.highest_segment + 1)
+            self.socket.sendto(feedback, self.server_address)
+            self.next_feedback = now + FEEDBACK_INTERVAL
+        if self.timestamps and now >= self.next_ping:
+            self.socket.sendto(PING_STRUCT.pack(MAGIC_COOKIE, MESSAGE_TYPE_PING, time.monotonic_ns()),
+                               self.server_address)
+            self.next_ping = now + PING_INTERVAL
+
+    def success_rate(self):
+        return (self.bitmap.count / self.total_segments) * 100 if self.total_segments else 0
+
+    def delay_summary(self):
+        """Latency, jitter, reordering and duplicate results of the transfer."""
+        return {**self.delay.summary(), **self.rtt.summary()}
+
+
+def path_datagram_size(server_address):
+    """Largest UDP payload that crosses the path to server_address unfragmented.
+
+    Reads the kernel's path MTU for the route (the interface MTU until ICMP
+    reports a smaller one) from a connected probe socket; where that is not
+    available the default BUFFER_SIZE is used.
+    """
+    if not sys.platform.startswith('linux'):
+        return BUFFER_SIZE
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+            probe.setsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER, IP_PMTUDISC_DO)
+            probe.connect(server_address)
+            mtu = probe.getsockopt(socket.IPPROTO_IP, IP_MTU)
+    except OSError:
+        return BUFFER_SIZE
+    return max(MIN_DATAGRAM_SIZE, min(MAX_DATAGRAM_SIZE, mtu - IP_UDP_HEADER_SIZE))
+
+
+def build_udp_request(file_size, stripe=None, reliable=False, timestamps=False, datagram_size=BUFFER_SIZE):
+    """Request packet for a whole-file or striped UDP transfer.
+
+    Plain whole-file transfers keep the original REQUEST_FORMAT packets so older
+    servers still understand them; anything else needs a range request, and a
+    datagram size other than BUFFER_SIZE needs its sized version.
+    """
+    if stripe is None and not timestamps and datagram_size == BUFFER_SIZE:
+        message_type = MESSAGE_TYPE_RELIABLE_REQUEST if reliable else MESSAGE_TYPE_REQUEST
+        return REQUEST_STRUCT.pack(MAGIC_COOKIE, message_type, file_size)
+    flags = (RANGE_FLAG_RELIABLE if reliable else 0) | (RANGE_FLAG_TIMESTAMPS if timestamps else 0)
+    offset, length = (stripe.offset, stripe.length) if stripe else (0, file_size)
+    if datagram_size == BUFFER_SIZE:
+        return RANGE_REQUEST_STRUCT.pack(MAGIC_COOKIE, MESSAGE_TYPE_RANGE_REQUEST, REQUEST_VERSION, flags,
+                                         file_size, offset, length)
+    return SIZED_RANGE_REQUEST_STRUCT.pack(MAGIC_COOKIE, MESSAGE_TYPE_RANGE_REQUEST, SIZED_REQUEST_VERSION, flags,
+                                           file_size, offset, length, datagram_size)
@@ -0,0 +1,74 @@
+import asyncio
+import mmap
+import os
+import tempfile
+
+# Size of the repeating pattern every payload is cut from
+PATTERN_SIZE = 4 * 1024 * 1024
+TCP_SEND_CHUNK = 256 * 1024     # Bytes handed to the kernel per send before yielding
+
+
+class PayloadSource:
+    """Read-only payload pattern shared by every transfer of a worker.
+
+    The pattern lives in an unlinked temporary file that is memory-mapped once.
+    TCP payloads go out with sendfile() straight from the file, or as memoryview
+    slices of the mapping where sendfile is unavailable, and UDP datagrams are
+    gathered from views of the mapping, so memory use does not depend on the
+    requested file size. Byte ``i`` of every transfer is
+    ``pattern[i % PATTERN_SIZE]``.
+    """
+
+    def __init__(self, size=PATTERN_SIZE):
+        self.size = size
+        self.file = tempfile.TemporaryFile()
+        self.file.write(bytes(range(256)) * (size // 256))
+        self.file.flush()
+        self.map = mmap.mmap(self.file.fileno(), size, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+        self.use_sendfile = hasattr(os, 'sendfile')
+
+        # Bytes handed to the kernel, and bytes Python copied to produce them
+        self.bytes_sent = 0
+        self.bytes_copied = 0
+
+    def record(self, sent, copied=0):
+        """Account for bytes sent and the user-space copies made for them."""
+        self.bytes_sent += sent
+        self.bytes_copied += copied
+
+    def copy_ratio(self):
+        """Bytes copied in user space per byte sent (0.0 for a zero-copy path)."""
+        return self.bytes_copied / self.bytes_sent if self.bytes_sent else 0.0
+
+    def views(self, offset, length):
+        """Return the memoryviews (one, or two where the pattern wraps) holding length bytes at absolute offset."""
+        start = offset % self.size
+        if start + length <= self.size:
+            return [self.view[start:start + length]]
+        return [self.view[start:], self.view[:start + length - self.size]]
+
+    async def send_tcp(self, sock, offset, count):
+        """Stream count bytes of the pattern, starting at absolute offset, to a TCP socket."""
+        loop = asyncio.get_running_loop()
+        while count:
+            start = offset % self.size
+            chunk = min(count, self.size - start, TCP_SEND_CHUNK)
+            if self.use_sendfile:
+                try:
+                    await loop.sock_sendfile(sock, self.file, start, chunk, fallback=False)
+                except asyncio.SendfileNotAvailableError:
+                    self.use_sendfile = False
+                    continue
+            else:
+                await loop.sock_sendall(sock, self.view[start:start + chunk])
+            self.record(chunk)
+            offset += chunk
+            count -= chunk
+            # Neither call yields while the socket stays writable; let other transfers run
+            await asyncio.sleep(0)
+
+    def close(self):
+        self.view.release()
+        self.map.close()
+        self.file.close()
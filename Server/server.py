@@ -1,146 +1,557 @@
+import argparse
+import asyncio
+import multiprocessing
+import signal
 import socket
 import struct
-import time
-from tqdm import tqdm
-from threading import Thread
 import sys
 import os
 from collections import defaultdict
-import threading
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../')))
 from Shared.shared import *
+from Server.payload import PayloadSource
+from Server.udp_sender import TokenBucket, UdpSender
 
+# Server tuning
+LISTEN_BACKLOG = 4096
+MAX_REQUEST_LINE = 80           # Longest accepted TCP request line
+REQUEST_READ_SIZE = 4096        # Bytes read at a time from a connection's request stream
+REQUEST_TIMEOUT = 5             # Seconds a TCP client has to send its request
+SESSION_IDLE_TIMEOUT = 30       # Seconds a session may wait between requests
+DEFAULT_MAX_TRANSFERS = 1024
+DEFAULT_MAX_PER_CLIENT = 64
+DEFAULT_MAX_FILE_SIZE = 100 * 1024 ** 3
+STATS_INTERVAL = 5              # Seconds between server throughput/copy reports
 
-def listen_for_offers():
-    """Listen for server offers via UDP."""
-    udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    udp_socket.bind(('', DEFAULT_UDP_PORT))
 
-    print(f"{bcolors.OKCYAN}Listening for server offers...{bcolors.ENDC}")
-    while True:
+class RequestReader:
+    """Reads request lines from a TCP connection, keeping pipelined bytes for the next call."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.buffer = b''
+
+    async def read_line(self, timeout):
+        """Return the next line without its newline, or None if the client closed the connection."""
+        loop = asyncio.get_running_loop()
+        while b'\n' not in self.buffer:
+            if len(self.buffer) > MAX_REQUEST_LINE:
+                raise ValueError("request line too long")
+            chunk = await asyncio.wait_for(loop.sock_recv(self.conn, REQUEST_READ_SIZE), timeout)
+            if not chunk:
+                if self.buffer:
+                    raise ValueError("truncated request line")
+                return None
+            self.buffer += chunk
+        line, self.buffer = self.buffer.split(b'\n', 1)
+        if len(line) > MAX_REQUEST_LINE:
+            raise ValueError("request line too long")
+        return line
+
+
+class UdpTransfer:
+    """Server-side state of one UDP transfer, indexed by client address."""
+
+    def __init__(self):
+        self.control = asyncio.Queue()  # NACK and DONE messages for the repair loop
+        self.repairing = False
+        self.task = None
+
+
+class SpeedTestServer:
+    """Event-driven speed-test server: one asyncio loop serves every client."""
+
+    def __init__(self, tcp_port, udp_port, max_transfers=DEFAULT_MAX_TRANSFERS,
+                 max_per_client=DEFAULT_MAX_PER_CLIENT, max_file_size=DEFAULT_MAX_FILE_SIZE,
+                 broadcast_address='<broadcast>', announce=True, reuse_port=False,
+                 udp_rate=0, udp_total_rate=0, udp_adaptive=False, udp_target_loss=0.01):
+        self.tcp_port = tcp_port
+        self.udp_port = udp_port
+        self.max_transfers = max_transfers
+        self.max_per_client = max_per_client
+        self.max_file_size = max_file_size
+        self.broadcast_address = broadcast_address
+        self.announce = announce
+        self.reuse_port = reuse_port
+        self.udp_rate = udp_rate
+        self.udp_adaptive = udp_adaptive
+        self.udp_target_loss = udp_target_loss
+        self.udp_pacer = TokenBucket(udp_total_rate)
+
+        self.active_transfers = 0
+        self.client_transfers = defaultdict(int)
+        self.udp_transfers = {}
+        self.tasks = set()
+        self.payload = PayloadSource()
+
+    def open_sockets(self):
+        """Bind the TCP listener and the UDP request socket."""
+        self.tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for sock in (self.tcp_socket, self.udp_socket):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self.reuse_port:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            sock.setblocking(False)
+        if hasattr(socket, 'SO_REUSEPORT'):
+            # Transfer sockets share the request port (see open_transfer_socket)
+            self.udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+        self.tcp_socket.bind(('', self.tcp_port))
+        self.tcp_socket.listen(LISTEN_BACKLOG)
+        self.udp_socket.bind(('', self.udp_port))
+        self.tcp_port = self.tcp_socket.getsockname()[1]
+        self.udp_port = self.udp_socket.getsockname()[1]
+
+    def spawn(self, coroutine):
+        """Run a coroutine in the background, keeping a reference until it finishes."""
+        task = asyncio.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    def validate(self, file_size, offset=0, length=None):
+        """Return why a request for a file or byte range is invalid, or None."""
+        if not 0 < file_size <= self.max_file_size:
+            return f"invalid file size {file_size}"
+        if length is not None and not (0 <= offset and 0 < length and offset + length <= file_size):
+            return f"invalid range {offset}+{length} of {file_size}"
+        return None
+
+    def reserve(self, client_ip):
+        """Reserve a transfer slot, returning the rejection reason if there is none."""
+        if self.active_transfers >= self.max_transfers:
+            return "server busy"
+        if self.client_transfers[client_ip] >= self.max_per_client:
+            return "too many transfers from this client"
+        self.active_transfers += 1
+        self.client_transfers[client_ip] += 1
+        return None
+
+    def admit(self, client_ip, file_size, offset=0, length=None):
+        """Validate a request and reserve its transfer slot, returning the rejection reason if any."""
+        return self.validate(file_size, offset, length) or self.reserve(client_ip)
+
+    def release(self, client_ip):
+        """Free a transfer slot reserved by admit()."""
+        self.active_transfers -= 1
+        self.client_transfers[client_ip] -= 1
+        if not self.client_transfers[client_ip]:
+            del self.client_transfers[client_ip]
+
+    async def broadcast_offers(self):
+        """Announce the server on the offer port once per OFFER_INTERVAL."""
+        offer = struct.pack(OFFER_FORMAT, MAGIC_COOKIE, MESSAGE_TYPE_OFFER, self.udp_port, self.tcp_port)
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as offer_socket:
+            offer_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            offer_socket.setblocking(False)
+            print(f"{bcolors.OKCYAN}Broadcasting offers to {self.broadcast_address}:{DEFAULT_UDP_PORT}...{bcolors.ENDC}")
+            while True:
+                try:
+                    offer_socket.sendto(offer, (self.broadcast_address, DEFAULT_UDP_PORT))
+                except OSError as e:
+                    print(f"{bcolors.WARNING}Error broadcasting offer: {e}{bcolors.ENDC}")
+                await asyncio.sleep(OFFER_INTERVAL)
+
+    async def accept_tcp(self):
+        """Accept TCP clients and hand each one to its own task."""
+        loop = asyncio.get_running_loop()
+        print(f"{bcolors.OKCYAN}Server listening on TCP port {self.tcp_port}{bcolors.ENDC}")
+        while True:
+            try:
+                conn, addr = await loop.sock_accept(self.tcp_socket)
+            except OSError as e:
+                # Typically EMFILE: back off instead of spinning on the listener
+                print(f"{bcolors.WARNING}Error accepting TCP client: {e}{bcolors.ENDC}")
+                await asyncio.sleep(0.1)
+                continue
+            conn.setblocking(False)
+            self.spawn(self.handle_tcp(conn, addr))
+
+    async def handle_tcp(self, conn, addr):
+        """Serve a single TCP transfer, or a session of pipelined ones."""
+        with conn:
+            try:
+                reader = RequestReader(conn)
+                line = await reader.read_line(REQUEST_TIMEOUT)
+                if line is None:
+                    return
+                if line + b'\n' == SESSION_HELLO.encode('utf-8'):
+                    await self.serve_session(conn, addr, reader)
+                    return
+                file_size, offset, length = parse_tcp_request(line)
+                reason = self.admit(addr[0], file_size, offset, length)
+                if reason:
+                    print(f"{bcolors.WARNING}Rejected TCP request from {addr[0]}: {reason}{bcolors.ENDC}")
+                    return
+                try:
+                    print(f"{bcolors.OKGREEN}Valid TCP request from {addr[0]}: {describe_range(file_size, offset, length)}{bcolors.ENDC}")
+                    await self.payload.send_tcp(conn, offset, length)
+                finally:
+                    self.release(addr[0])
+            except (asyncio.TimeoutError, ValueError, OSError) as e:
+                print(f"{bcolors.FAIL}Error serving TCP client {addr[0]}: {e}{bcolors.ENDC}")
+
+    async def serve_session(self, conn, addr, reader):
+        """Answer pipelined requests in order until the client closes the session or idles out.
+
+        A session holds one transfer slot for its whole life. An invalid request
+        ends the session, since the client could not tell its answer apart.
+        """
+        loop = asyncio.get_running_loop()
+        reason = self.reserve(addr[0])
+        if reason:
+            print(f"{bcolors.WARNING}Rejected TCP session from {addr[0]}: {reason}{bcolors.ENDC}")
+            return
+        served = 0
         try:
-            data, addr = udp_socket.recvfrom(BUFFER_SIZE)
-            magic_cookie, message_type, udp_port, tcp_port = struct.unpack(OFFER_FORMAT, data)
-            if magic_cookie == MAGIC_COOKIE and message_type == MESSAGE_TYPE_OFFER:
-                print(f"{bcolors.OKGREEN}Offer received from {addr[0]}: UDP Port {udp_port}, TCP Port {tcp_port}{bcolors.ENDC}")
-                return addr[0], udp_port, tcp_port
-        except Exception as e:
-            print(f"{bcolors.FAIL}Error listening for offers: {e}{bcolors.ENDC}")
-
-def perform_tcp_connection(server_ip, tcp_port, file_size, connection_id, stats):
-    """Perform a TCP file transfer."""
-    try:
-        start_time = time.time()
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as tcp_socket:
-            tcp_socket.connect((server_ip, tcp_port))
-            tcp_socket.sendall(f"{file_size}\n".encode('utf-8'))
-
-            received = 0
-            progress = tqdm(total=file_size, unit='B', unit_scale=True, desc=f"TCP {connection_id}{bcolors.ENDC}")
-            while received < file_size:
-                data = tcp_socket.recv(BUFFER_SIZE)
-                received += len(data)
-                progress.update(len(data))
-                stats['total_bytes'] += len(data)
-            progress.close()
-
-        elapsed_time = time.time() - start_time
-        stats['elapsed_time'] += elapsed_time
-        speed = (file_size * 8) / elapsed_time
-        print(f"{bcolors.OKGREEN}TCP {connection_id} Complete: Time: {elapsed_time:.2f}s, Speed: {speed:.2f} bits/s{bcolors.ENDC}")
-    except Exception as e:
-        print(f"{bcolors.FAIL}Error during TCP {connection_id}: {e}{bcolors.ENDC}")
-
-def perform_udp_connection(server_ip, udp_port, file_size, connection_id, stats):
-    """Perform a UDP file transfer."""
-    udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    udp_socket.settimeout(UDP_TIMEOUT)
-
-    request_packet = struct.pack(REQUEST_FORMAT, MAGIC_COOKIE, MESSAGE_TYPE_REQUEST, file_size)
-    udp_socket.sendto(request_packet, (server_ip, udp_port))
-
-    received_segments = 0
-    total_segments = (file_size + BUFFER_SIZE - 21 -  1) // (BUFFER_SIZE-21)
-    missing_segments = set(range(total_segments))
-    start_time = time.time()
-
-    progress = tqdm(total=file_size, unit='B', unit_scale=True, desc=f"UDP {connection_id}{bcolors.ENDC}")
-    while True:
+            # Small answers must not wait for Nagle's algorithm
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            await loop.sock_sendall(conn, SESSION_ACK.encode('utf-8'))
+            print(f"{bcolors.OKGREEN}TCP session opened by {addr[0]}{bcolors.ENDC}")
+            while True:
+                try:
+                    line = await reader.read_line(SESSION_IDLE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    break
+                if line is None:
+                    break
+                file_size, offset, length = parse_tcp_request(line)
+                reason = self.validate(file_size, offset, length)
+                if reason:
+                    raise ValueError(reason)
+                await self.payload.send_tcp(conn, offset, length)
+                served += 1
+        finally:
+            self.release(addr[0])
+            print(f"{bcolors.OKGREEN}TCP session from {addr[0]} closed after {served} requests{bcolors.ENDC}")
+
+    async def serve_udp_requests(self):
+        """Receive UDP requests and start a transfer task for each valid one."""
+        loop = asyncio.get_running_loop()
+        print(f"{bcolors.OKCYAN}Server listening on UDP port {self.udp_port}{bcolors.ENDC}")
+        while True:
+            try:
+                data, addr = await loop.sock_recvfrom(self.udp_socket, BUFFER_SIZE)
+            except OSError as e:
+                print(f"{bcolors.WARNING}Error receiving UDP request: {e}{bcolors.ENDC}")
+                continue
+            try:
+                magic_cookie, message_type = MESSAGE_HEADER_STRUCT.unpack_from(data)
+                if magic_cookie != MAGIC_COOKIE:
+                    continue
+                if message_type == MESSAGE_TYPE_PING:
+                    self.answer_ping(self.udp_socket, data, addr)
+                else:
+                    self.handle_udp_request(data, addr)
+            except (struct.error, OSError):
+                # Malformed requests, and PONGs the kernel refused to send, are dropped
+                continue
+
+    def handle_udp_request(self, data, addr):
+        """Admit a UDP request and start its transfer task; anything else is ignored.
+
+        Raises struct.error for a malformed request.
+        """
+        message_type = data[4]
+        datagram_size = BUFFER_SIZE
+        if message_type in (MESSAGE_TYPE_REQUEST, MESSAGE_TYPE_RELIABLE_REQUEST):
+            _, _, file_size = REQUEST_STRUCT.unpack(data)
+            offset, length = 0, file_size
+            reliable = message_type == MESSAGE_TYPE_RELIABLE_REQUEST
+            timestamps = False
+        elif message_type == MESSAGE_TYPE_RANGE_REQUEST:
+            version = data[5] if len(data) > 5 else None
+            if version == REQUEST_VERSION:
+                _, _, _, flags, file_size, offset, length = RANGE_REQUEST_STRUCT.unpack(data)
+            elif version == SIZED_REQUEST_VERSION:
+                _, _, _, flags, file_size, offset, length, datagram_size = SIZED_RANGE_REQUEST_STRUCT.unpack(data)
+                if not MIN_DATAGRAM_SIZE <= datagram_size <= MAX_DATAGRAM_SIZE:
+                    return
+            else:
+                return
+            reliable = bool(flags & RANGE_FLAG_RELIABLE)
+            timestamps = bool(flags & RANGE_FLAG_TIMESTAMPS)
+        else:
+            return
+        previous = self.udp_transfers.get(addr)
+        if previous is not None:
+            if not previous.repairing:
+                # A client repeating its request while the segments are still going out
+                return
+            # Once the segments are out, only a client that has them all (or none) asks
+            # again, e.g. for a session's next trial: its DONE may still be queued
+            previous.control.put_nowait((MESSAGE_TYPE_DONE, None))
+        reason = self.admit(addr[0], file_size, offset, length)
+        if reason:
+            print(f"{bcolors.WARNING}Rejected UDP request from {addr[0]}: {reason}{bcolors.ENDC}")
+            return
+        print(f"{bcolors.OKGREEN}Valid {'reliable ' if reliable else ''}UDP request from {addr[0]}: "
+              f"{describe_range(file_size, offset, length)}, {datagram_size}-byte datagrams{bcolors.ENDC}")
+        # Segments are numbered within the requested range
+        transfer = self.udp_transfers[addr] = UdpTransfer()
+        transfer.task = self.spawn(self.handle_udp(addr, length, transfer, reliable, timestamps, datagram_size, offset))
+
+    def open_transfer_socket(self, addr):
+        """UDP socket connected to a client, sending from the request port where SO_REUSEPORT allows.
+
+        Replies then keep the 5-tuple of the client's request, so stateful firewalls
+        and port-restricted NATs let them through. The kernel delivers the client's
+        datagrams to the connected socket rather than to the request socket.
+        """
+        udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         try:
-            data, _ = udp_socket.recvfrom(BUFFER_SIZE)
-            header = data[:21]
-            payload = data[21:]
-
-            magic_cookie, message_type, total_segments, segment_number = struct.unpack(PAYLOAD_FORMAT, header)
-            if magic_cookie == MAGIC_COOKIE and message_type == MESSAGE_TYPE_PAYLOAD:
-                if segment_number in missing_segments:
-                    received_segments += 1
-                    missing_segments.remove(segment_number)
-                progress.update(len(payload) )
-                stats['total_bytes'] += len(payload)
-        except socket.timeout:
-            break
-
-    progress.close()
-
-    elapsed_time = time.time() - start_time
-    stats['elapsed_time'] += elapsed_time
-    success_rate = (received_segments / total_segments) * 100 if total_segments else 0
-    speed = (received_segments * (BUFFER_SIZE -21) * 8) / elapsed_time
-    print(f"{bcolors.OKBLUE}UDP {connection_id} Complete: Time: {elapsed_time:.2f}s, Speed: {speed:.2f} bits/s, Success Rate: {success_rate:.2f}%{bcolors.ENDC}")
-
-def monitor_stats(stats, active_transfers):
-    """Continuously display real-time stats."""
-    while active_transfers.is_set():
-        speed = (stats['total_bytes'] * 8) / max(1, stats['elapsed_time'])
-        print(f"{bcolors.OKGREEN}Real-Time Stats: Speed: {speed:.2f} bits/s, Bytes Transferred: {stats['total_bytes']}{bcolors.ENDC}", end="\r")
-        time.sleep(1)
+            udp_socket.setblocking(False)
+            if hasattr(socket, 'SO_REUSEPORT'):
+                udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+                udp_socket.bind(('', self.udp_port))
+            udp_socket.connect(addr)
+        except OSError:
+            udp_socket.close()
+            raise
+        return udp_socket
 
-def main():
-    server_ip, udp_port, tcp_port = listen_for_offers()
+    async def handle_udp(self, addr, file_size, transfer, reliable=False, timestamps=False, datagram_size=BUFFER_SIZE,
+                         offset=0):
+        """Stream every segment of a UDP transfer (file_size bytes from offset) to the client."""
+        # Each transfer gets its own socket connected to the client: the sender owns its
+        # writability, and the client's control messages come back to this socket only.
+        udp_socket = None
+        try:
+            udp_socket = self.open_transfer_socket(addr)
+            sender = UdpSender(udp_socket, self.payload, file_size, TokenBucket(self.udp_rate), self.udp_pacer,
+                               adaptive=self.udp_adaptive, target_loss=self.udp_target_loss, timestamps=timestamps,
+                               datagram_size=datagram_size, offset=offset)
+            reader = self.spawn(self.read_udp_control(udp_socket, sender, transfer.control, addr))
+            try:
+                await sender.send_segments(0, sender.total_segments)
+                if reliable:
+                    transfer.repairing = True
+                    await self.repair_udp(udp_socket, sender, transfer.control, addr)
+            finally:
+                reader.cancel()
+        except OSError as e:
+            print(f"{bcolors.FAIL}Error sending UDP to {addr[0]}: {e}{bcolors.ENDC}")
+        finally:
+            if udp_socket is not None:
+                udp_socket.close()
+            if self.udp_transfers.get(addr) is transfer:
+                del self.udp_transfers[addr]
+            self.release(addr[0])
+
+    async def repair_udp(self, udp_socket, sender, control, addr):
+        """Selective repeat: announce the end of each round and resend whatever the client NACKs."""
+        total_segments = sender.total_segments
+        round_number = 0
+        retransmitted = 0
+        silent_rounds = 0
+        # NACKs sent during the first pass predate every FIN and list the tail that was not sent yet
+        while not control.empty():
+            message_type, _ = control.get_nowait()
+            if message_type == MESSAGE_TYPE_DONE:
+                print(f"{bcolors.OKGREEN}Reliable UDP transfer to {addr[0]} complete: "
+                      f"0 repair rounds, 0 segments retransmitted{bcolors.ENDC}")
+                return
+        while silent_rounds * RETRANSMIT_TIMEOUT < RELIABLE_TIMEOUT:
+            try:
+                udp_socket.send(FIN_STRUCT.pack(MAGIC_COOKIE, MESSAGE_TYPE_FIN, total_segments, round_number))
+            except BlockingIOError:
+                pass
+            try:
+                message = await asyncio.wait_for(control.get(), RETRANSMIT_TIMEOUT)
+            except asyncio.TimeoutError:
+                silent_rounds += 1
+                continue
+            silent_rounds = 0
 
-    # Prompt user for details
-    file_size = int(input(f"{bcolors.HEADER}Enter file size (bytes): {bcolors.ENDC}"))
-    tcp_connections = int(input(f"{bcolors.HEADER}Enter number of TCP connections: {bcolors.ENDC}"))
-    udp_connections = int(input(f"{bcolors.HEADER}Enter number of UDP connections: {bcolors.ENDC}"))
+            # Serve every NACK for the current round that is already queued, then start the next one
+            while message is not None:
+                message_type, body = message
+                if message_type == MESSAGE_TYPE_DONE:
+                    print(f"{bcolors.OKGREEN}Reliable UDP transfer to {addr[0]} complete: "
+                          f"{round_number} repair rounds, {retransmitted} segments retransmitted{bcolors.ENDC}")
+                    return
+                nack_round, ranges = body
+                if nack_round == round_number:
+                    for first, count in ranges:
+                        last = min(first + count, total_segments)
+                        await sender.send_segments(first, last)
+                        retransmitted += max(0, last - first)
+                message = None if control.empty() else control.get_nowait()
+            round_number += 1
+        print(f"{bcolors.WARNING}Reliable UDP transfer to {addr[0]} abandoned: client went silent{bcolors.ENDC}")
 
-    # Shared stats for monitoring
-    stats = {'total_bytes': 0, 'elapsed_time': 0}
-    active_transfers = threading.Event()
-    active_transfers.set()
+    def answer_ping(self, udp_socket, data, addr=None):
+        """Echo a PING's timestamp back as a PONG so the client can measure RTT and see the server's load."""
+        _, _, timestamp = PING_STRUCT.unpack_from(data)
+        pong = PONG_STRUCT.pack(MAGIC_COOKIE, MESSAGE_TYPE_PONG, timestamp, self.active_transfers, self.max_transfers)
+        try:
+            if addr is None:
+                udp_socket.send(pong)
+            else:
+                udp_socket.sendto(pong, addr)
+        except BlockingIOError:
+            pass
+
+    async def read_udp_control(self, udp_socket, sender, control, addr):
+        """Feed loss reports to the rate controller, answer pings and queue NACK/DONE for the repair loop.
+
+        The client's next request arrives here too, since this socket matches its address.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                data = await loop.sock_recv(udp_socket, BUFFER_SIZE)
+            except OSError:
+                return
+            try:
+                magic_cookie, message_type = MESSAGE_HEADER_STRUCT.unpack_from(data)
+                if magic_cookie != MAGIC_COOKIE:
+                    continue
+                if message_type == MESSAGE_TYPE_FEEDBACK:
+                    _, _, received, expected = struct.unpack(FEEDBACK_FORMAT, data)
+                    sender.on_feedback(received, expected)
+                elif message_type == MESSAGE_TYPE_NACK:
+                    control.put_nowait((message_type, unpack_nack(data)))
+                elif message_type == MESSAGE_TYPE_DONE:
+                    control.put_nowait((message_type, None))
+                elif message_type == MESSAGE_TYPE_PING:
+                    self.answer_ping(udp_socket, data)
+                else:
+                    self.handle_udp_request(data, addr)
+            except (struct.error, OSError):
+                continue
 
-    # Start real-time monitoring
-    monitor_thread = threading.Thread(target=monitor_stats, args=(stats, active_transfers))
-    monitor_thread.start()
+    async def report_stats(self):
+        """Periodically print throughput and how many bytes were copied per byte sent."""
+        last_sent = 0
+        while True:
+            await asyncio.sleep(STATS_INTERVAL)
+            sent = self.payload.bytes_sent
+            if sent == last_sent:
+                continue
+            speed = (sent - last_sent) * 8 / STATS_INTERVAL
+            print(f"{bcolors.OKBLUE}Server Stats: Active: {self.active_transfers}, Speed: {speed:.2f} bits/s, "
+                  f"Bytes Sent: {sent}, Bytes Copied: {self.payload.bytes_copied} "
+                  f"({self.payload.copy_ratio():.4f} per byte sent){bcolors.ENDC}")
+            last_sent = sent
 
-    # Perform TCP and UDP connections
-    threads = []
+    async def run(self):
+        """Open the sockets and serve until cancelled, then stop every transfer and release the payload."""
+        self.open_sockets()
+        try:
+            # Shut down as on Ctrl-C when the parent (or a benchmark) terminates the worker
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        except (NotImplementedError, RuntimeError):
+            pass
+        coroutines = [self.accept_tcp(), self.serve_udp_requests(), self.report_stats()]
+        if self.announce:
+            coroutines.append(self.broadcast_offers())
+        try:
+            await asyncio.gather(*coroutines)
+        finally:
+            # Transfers hold views of the payload mapping, which cannot close while they exist
+            for task in list(self.tasks):
+                task.cancel()
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+            self.tcp_socket.close()
+            self.udp_socket.close()
+            self.payload.close()
 
-    # Start TCP connections
-    for i in range(tcp_connections):
-        thread = Thread(target=perform_tcp_connection, args=(server_ip, tcp_port, file_size, i + 1, stats))
-        thread.start()
-        threads.append(thread)
 
-    # Start UDP connections
-    for i in range(udp_connections):
-        thread = Thread(target=perform_udp_connection, args=(server_ip, udp_port, file_size, i + 1, stats))
-        thread.start()
-        threads.append(thread)
+def describe_range(file_size, offset, length):
+    """Human-readable summary of a (possibly partial) request."""
+    if offset == 0 and length == file_size:
+        return f"{file_size} bytes"
+    return f"bytes {offset}-{offset + length - 1} of {file_size}"
 
-    # Wait for all threads to complete
-    for thread in threads:
-        thread.join()
 
-    # Stop monitoring
-    active_transfers.clear()
-    monitor_thread.join()
+def raise_file_limit():
+    """Allow as many open sockets as the hard limit permits."""
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
 
-    print(f"{bcolors.OKGREEN}All transfers complete.{bcolors.ENDC}")
 
-    print(f"{bcolors.OKGREEN}All transfers complete.{bcolors.ENDC}")
+def run_worker(args, worker_id):
+    """Run one event loop; with several workers the kernel spreads clients via SO_REUSEPORT."""
+    raise_file_limit()
+    server = SpeedTestServer(
+        args.tcp_port, args.udp_port,
+        max_transfers=max(1, args.max_transfers // args.workers),
+        max_per_client=args.max_per_client,
+        max_file_size=args.max_file_size,
+        broadcast_address=args.broadcast_address,
+        announce=worker_id == 0,
+        reuse_port=args.workers > 1,
+        udp_rate=args.udp_rate,
+        udp_total_rate=args.udp_total_rate / args.workers,
+        udp_adaptive=args.udp_adaptive,
+        udp_target_loss=args.udp_target_loss,
+    )
+    try:
+        asyncio.run(server.run())
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Network speed test server")
+    parser.add_argument('--tcp-port', type=int, default=DEFAULT_TCP_PORT)
+    parser.add_argument('--udp-port', type=int, default=DEFAULT_SERVER_UDP_PORT)
+    parser.add_argument('--workers', type=int, default=1,
+                        help="event loops to run, one process each (use os.cpu_count() for one per core)")
+    parser.add_argument('--max-transfers', type=int, default=DEFAULT_MAX_TRANSFERS,
+                        help="concurrent transfers admitted across all workers")
+    parser.add_argument('--max-per-client', type=int, default=DEFAULT_MAX_PER_CLIENT,
+                        help="concurrent transfers admitted per client IP and worker")
+    parser.add_argument('--max-file-size', type=int, default=DEFAULT_MAX_FILE_SIZE)
+    parser.add_argument('--broadcast-address', default='<broadcast>')
+    parser.add_argument('--udp-rate', type=float, default=0,
+                        help="pacing rate per UDP transfer in bits/s (0 = unpaced)")
+    parser.add_argument('--udp-total-rate', type=float, default=0,
+                        help="pacing rate shared by all UDP transfers in bits/s (0 = unpaced)")
+    parser.add_argument('--udp-adaptive', action='store_true',
+                        help="adapt each UDP transfer's rate to the loss its client reports")
+    parser.add_argument('--udp-target-loss', type=float, default=0.01,
+                        help="loss fraction the adaptive rate control aims for")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    print(f"{bcolors.HEADER}Starting server...{bcolors.ENDC}")
+    if args.workers > 1 and not hasattr(socket, 'SO_REUSEPORT'):
+        print(f"{bcolors.WARNING}SO_REUSEPORT unavailable, running a single worker{bcolors.ENDC}")
+        args.workers = 1
+
+    if args.workers == 1:
+        run_worker(args, 0)
+        return
+
+    workers = [multiprocessing.Process(target=run_worker, args=(args, i)) for i in range(args.workers)]
+    for worker in workers:
+        worker.start()
+
+    def stop_workers(signum, frame):
+        # Workers hold the ports through SO_REUSEPORT; they must not outlive the parent
+        for worker in workers:
+            worker.terminate()
+
+    signal.signal(signal.SIGTERM, stop_workers)
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.join()
+    print(f"{bcolors.OKGREEN}Server stopped.{bcolors.ENDC}")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,194 @@
+import asyncio
+import errno
+import socket
+import struct
+import sys
+import time
+
+from Shared.shared import *
+
+# Linux UDP generic segmentation offload: one sendmsg() carries a burst that the
+# kernel (or NIC) splits into equally sized datagrams.
+SOL_UDP = getattr(socket, 'SOL_UDP', 17)
+UDP_SEGMENT = getattr(socket, 'UDP_SEGMENT', 103)
+GSO_MAX_SEGMENTS = 64
+GSO_MAX_BYTES = 65000           # Stay below the 64 KiB IP datagram limit
+
+# Rate control
+PACER_BURST = 256 * 1024        # Bytes a token bucket may send back to back
+MIN_RATE = 1_000_000            # Adaptive mode never paces below 1 Mbit/s
+INITIAL_ADAPTIVE_RATE = 100_000_000
+RATE_DECREASE = 0.8             # Multiplicative decrease when loss exceeds the target
+RATE_INCREASE = 1.05            # Multiplicative probe when loss is below the target
+
+
+def gso_supported():
+    """Return True if the kernel accepts UDP_SEGMENT on a UDP socket."""
+    if not sys.platform.startswith('linux'):
+        return False
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+            probe.setsockopt(SOL_UDP, UDP_SEGMENT, BUFFER_SIZE)
+        return True
+    except OSError:
+        return False
+
+
+async def wait_writable(sock):
+    """Wait until a non-blocking socket can accept more data."""
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    loop.add_writer(sock.fileno(), lambda: future.done() or future.set_result(None))
+    try:
+        await future
+    finally:
+        loop.remove_writer(sock.fileno())
+
+
+class TokenBucket:
+    """Byte-based token bucket; a rate of 0 disables pacing."""
+
+    def __init__(self, rate_bps=0, burst=PACER_BURST):
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+        self.set_rate(rate_bps)
+
+    def set_rate(self, rate_bps):
+        self.rate_bps = rate_bps
+        self.rate = rate_bps / 8
+
+    def delay(self, nbytes):
+        """Take nbytes of tokens and return how many seconds to wait before sending them."""
+        if not self.rate:
+            return 0
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        self.tokens -= nbytes
+        return -self.tokens / self.rate if self.tokens < 0 else 0
+
+
+class UdpSender:
+    """Paced, batched sender for the segments of one UDP transfer.
+
+    Segments are sent in bursts: with GSO a whole burst is one sendmsg() call,
+    otherwise the burst falls back to one sendmsg() per datagram. Only headers
+    are packed, in place; each datagram is gathered from its header and the
+    pattern views at the segment's absolute offset, so a range transfer carries
+    the same bytes as the TCP stream of that range. The transfer socket is
+    connected to the client, so its feedback reports arrive on the same socket.
+    """
+
+    use_gso = gso_supported()
+
+    def __init__(self, sock, payload, file_size, pacer, server_pacer, adaptive=False, target_loss=0.01,
+                 timestamps=False, datagram_size=BUFFER_SIZE, offset=0):
+        self.sock = sock
+        self.payload = payload
+        self.file_size = file_size
+        self.offset = offset
+        self.timestamps = timestamps
+        self.header_size, self.segment_size = payload_layout(datagram_size, timestamps)
+        self.total_segments = (file_size + self.segment_size - 1) // self.segment_size
+        self.pacer = pacer
+        self.server_pacer = server_pacer
+        self.adaptive = adaptive
+        self.target_loss = target_loss
+        if adaptive and not pacer.rate:
+            pacer.set_rate(INITIAL_ADAPTIVE_RATE)
+
+        self.datagram_size = self.header_size + self.segment_size
+        self.burst_segments = max(1, min(GSO_MAX_SEGMENTS, GSO_MAX_BYTES // self.datagram_size))
+        self.headers = bytearray(self.burst_segments * self.header_size)
+        headers = memoryview(self.headers)
+        self.header_views = [headers[slot * self.header_size:(slot + 1) * self.header_size]
+                             for slot in range(self.burst_segments)]
+        self.gso_option = [(SOL_UDP, UDP_SEGMENT, struct.pack('=H', self.datagram_size))]
+        self.last_report = (0, 0)
+
+    def segment_length(self, segment_number):
+        """Datagram length of a segment; only the final one can be short."""
+        return self.header_size + min(self.segment_size, self.file_size - segment_number * self.segment_size)
+
+    def datagram(self, slot, segment_number):
+        """Buffers of one datagram: its packed header, then its pattern bytes."""
+        return [self.header_views[slot],
+                *self.payload.views(self.offset + segment_number * self.segment_size,
+                                    self.segment_length(segment_number) - self.header_size)]
+
+    async def send_segments(self, first, last):
+        """Send segments [first, last) in paced bursts."""
+        while first < last:
+            count = min(self.burst_segments, last - first)
+            length = (count - 1) * self.datagram_size + self.segment_length(first + count - 1)
+
+            delay = max(self.pacer.delay(length), self.server_pacer.delay(length))
+            if delay:
+                await asyncio.sleep(delay)
+            else:
+                # Let other transfers have the loop between bursts
+                await asyncio.sleep(0)
+
+            # Headers are packed after pacing so timestamps reflect the actual send time
+            if self.timestamps:
+                sent_ns = time.monotonic_ns()
+                for slot in range(count):
+                    PAYLOAD_TS_STRUCT.pack_into(self.headers, slot * self.header_size, MAGIC_COOKIE,
+                                                MESSAGE_TYPE_PAYLOAD_TS, self.total_segments, first + slot, sent_ns)
+            else:
+                for slot in range(count):
+                    PAYLOAD_STRUCT.pack_into(self.headers, slot * self.header_size, MAGIC_COOKIE,
+                                             MESSAGE_TYPE_PAYLOAD, self.total_segments, first + slot)
+
+            await self.send_burst([self.datagram(slot, first + slot) for slot in range(count)])
+            self.payload.record(length, count * self.header_size)
+            first += count
+
+    async def send_burst(self, datagrams):
+        """Hand a burst of datagrams, each a list of buffers, to the kernel."""
+        if self.use_gso and len(datagrams) > 1:
+            buffers = [buffer for datagram in datagrams for buffer in datagram]
+            while True:
+                try:
+                    self.sock.sendmsg(buffers, self.gso_option)
+                    return
+                except BlockingIOError:
+                    await wait_writable(self.sock)
+                except OSError as e:
+                    if isinstance(e, ConnectionError):
+                        raise
+                    # EIO: the device cannot segment, so give up on GSO for good. Anything else
+                    # (e.g. EMSGSIZE: this client's datagrams exceed the route MTU) only
+                    # disables it for this transfer
+                    self.use_gso = False
+                    if e.errno == errno.EIO:
+                        UdpSender.use_gso = False
+                    break
+
+        for datagram in datagrams:
+            while True:
+                try:
+                    if hasattr(self.sock, 'sendmsg'):
+                        self.sock.sendmsg(datagram)
+                    else:
+                        self.sock.send(b''.join(datagram))
+                    break
+                except BlockingIOError:
+                    await wait_writable(self.sock)
+
+    def on_feedback(self, received, expected):
+        """Adapt the pacing rate to the loss seen since the previous client report."""
+        received_delta = received - self.last_report[0]
+        expected_delta = expected - self.last_report[1]
+        if expected_delta <= 0 or received_delta < 0:
+            return
+        self.last_report = (received, expected)
+        if not self.adaptive:
+            return
+        loss = max(0.0, 1 - received_delta / expected_delta)
+        if loss > self.target_loss:
+            rate = max(MIN_RATE, self.pacer.rate_bps * RATE_DECREASE)
+        else:
+            rate = self.pacer.rate_bps * RATE_INCREASE
+        self.pacer.set_rate(rate)
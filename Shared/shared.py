@@ -1,5 +1,8 @@
 # Constants and shared functions for the Hackathon project
 
+import os
+import struct
+
 class bcolors:
     HEADER = '\033[95m'
     OKBLUE = '\033[94m'
@@ -16,18 +19,113 @@ MAGIC_COOKIE = 0xabcddcba
 MESSAGE_TYPE_OFFER = 0x2
 MESSAGE_TYPE_REQUEST = 0x3
 MESSAGE_TYPE_PAYLOAD = 0x4
+MESSAGE_TYPE_FEEDBACK = 0x5
+MESSAGE_TYPE_RELIABLE_REQUEST = 0x6  # REQUEST_FORMAT layout, asks for selective-repeat delivery
+MESSAGE_TYPE_NACK = 0x7
+MESSAGE_TYPE_FIN = 0x8
+MESSAGE_TYPE_DONE = 0x9
+MESSAGE_TYPE_RANGE_REQUEST = 0xa
+MESSAGE_TYPE_PAYLOAD_TS = 0xb  # Payload header version 2, carrying the send timestamp
+MESSAGE_TYPE_PING = 0xc
+MESSAGE_TYPE_PONG = 0xd
+
+# Versioned range requests: ask for bytes [offset, offset + length) of a file_size object
+REQUEST_VERSION = 1
+SIZED_REQUEST_VERSION = 2  # UDP range request that also names the datagram size to send
+RANGE_FLAG_RELIABLE = 0x1
+RANGE_FLAG_TIMESTAMPS = 0x2  # Send MESSAGE_TYPE_PAYLOAD_TS segments
 
 # Default Ports
 DEFAULT_UDP_PORT = 13117
 DEFAULT_TCP_PORT = 12345
+DEFAULT_SERVER_UDP_PORT = 13118  # Port the server receives UDP requests on
 
-# Buffer Size
-BUFFER_SIZE = 1024
+# Buffer Size: datagram size of requests without a negotiated size, and the size of
+# control packets; benchmarks sweep it through the environment of both processes
+BUFFER_SIZE = int(os.environ.get('SPEEDTEST_BUFFER_SIZE', 1024))
+
+# Negotiated UDP datagram sizes
+IP_UDP_HEADER_SIZE = 28  # IPv4 and UDP headers, subtracted from the path MTU
+MIN_DATAGRAM_SIZE = 64
+MAX_DATAGRAM_SIZE = 65507  # Largest IPv4 UDP payload
 
 # Packet Formats
 OFFER_FORMAT    = "!IBHH"      # Magic cookie, message type, UDP port, TCP port
 REQUEST_FORMAT  = "!IBQ"     # Magic Cookie (4 bytes), Message Type (1 byte), File Size (8 bytes)
 PAYLOAD_FORMAT  = "!IBQQ"    # Magic cookie, message type, total segments, current segment
+PAYLOAD_TS_FORMAT = "!IBQQQ"  # Magic cookie, message type, total segments, current segment, send time (monotonic ns)
+PING_FORMAT     = "!IBQ"     # Magic cookie, message type, sender's monotonic ns (echoed back in the PONG)
+PONG_FORMAT     = "!IBQII"   # PING_FORMAT followed by the server's active transfers and transfer capacity
+FEEDBACK_FORMAT = "!IBQQ"    # Magic cookie, message type, segments received, segments expected (highest seen + 1)
+
+RANGE_REQUEST_FORMAT = "!IBBBQQQ"  # Magic cookie, message type, version, flags, file size, offset, length
+SIZED_RANGE_REQUEST_FORMAT = "!IBBBQQQH"  # RANGE_REQUEST_FORMAT followed by the datagram size (version 2)
+TCP_RANGE_REQUEST = "V{version} {file_size} {offset} {length}\n"  # TCP counterpart of "<size>\n"
+
+# Persistent TCP sessions: after SESSION_HELLO is acknowledged, the client may pipeline
+# any number of request lines; the server answers them in order on the same connection
+SESSION_VERSION = 1
+SESSION_HELLO = f"S{SESSION_VERSION}\n"
+SESSION_ACK = f"S{SESSION_VERSION} OK\n"
+NACK_FORMAT     = "!IBIH"    # Magic cookie, message type, round, range count; followed by the ranges
+NACK_RANGE_FORMAT = "!QI"    # First missing segment, number of missing segments
+FIN_FORMAT      = "!IBQI"    # Magic cookie, message type, total segments, round
+DONE_FORMAT     = "!IBQ"     # Magic cookie, message type, segments received
+
+MESSAGE_HEADER_STRUCT = struct.Struct("!IB")  # Magic cookie and message type shared by every packet
+PAYLOAD_STRUCT = struct.Struct(PAYLOAD_FORMAT)
+PAYLOAD_TS_STRUCT = struct.Struct(PAYLOAD_TS_FORMAT)
+PING_STRUCT = struct.Struct(PING_FORMAT)
+PONG_STRUCT = struct.Struct(PONG_FORMAT)
+OFFER_STRUCT = struct.Struct(OFFER_FORMAT)
+REQUEST_STRUCT = struct.Struct(REQUEST_FORMAT)
+RANGE_REQUEST_STRUCT = struct.Struct(RANGE_REQUEST_FORMAT)
+SIZED_RANGE_REQUEST_STRUCT = struct.Struct(SIZED_RANGE_REQUEST_FORMAT)
+NACK_STRUCT = struct.Struct(NACK_FORMAT)
+NACK_RANGE_STRUCT = struct.Struct(NACK_RANGE_FORMAT)
+FIN_STRUCT = struct.Struct(FIN_FORMAT)
+NACK_MAX_RANGES = (BUFFER_SIZE - NACK_STRUCT.size) // NACK_RANGE_STRUCT.size
+PAYLOAD_HEADER_SIZE = PAYLOAD_STRUCT.size
 
 # Timeouts
 UDP_TIMEOUT = 1  # 1 second timeout for UDP transfers
+OFFER_INTERVAL = 1  # Seconds between server offer broadcasts
+FEEDBACK_INTERVAL = 0.05  # Seconds between client loss reports during a UDP transfer
+RETRANSMIT_TIMEOUT = 0.2  # Seconds of silence before a reliable UDP peer repeats its FIN/NACK
+RELIABLE_TIMEOUT = 5  # Seconds of silence after which a reliable UDP transfer is abandoned
+PING_INTERVAL = 0.1  # Seconds between RTT probes during a UDP transfer
+
+
+def pack_nack(round_number, ranges):
+    """Build a NACK packet listing up to NACK_MAX_RANGES (first, count) runs of missing segments."""
+    packet = bytearray(NACK_STRUCT.size + len(ranges) * NACK_RANGE_STRUCT.size)
+    NACK_STRUCT.pack_into(packet, 0, MAGIC_COOKIE, MESSAGE_TYPE_NACK, round_number, len(ranges))
+    for index, (first, count) in enumerate(ranges):
+        NACK_RANGE_STRUCT.pack_into(packet, NACK_STRUCT.size + index * NACK_RANGE_STRUCT.size, first, count)
+    return packet
+
+
+def unpack_nack(data):
+    """Parse a NACK packet into (round, [(first, count), ...])."""
+    _, _, round_number, range_count = NACK_STRUCT.unpack_from(data)
+    ranges = [NACK_RANGE_STRUCT.unpack_from(data, NACK_STRUCT.size + index * NACK_RANGE_STRUCT.size)
+              for index in range(range_count)]
+    return round_number, ranges
+
+
+def payload_layout(datagram_size, timestamps=False):
+    """Return (header size, payload bytes per segment) of datagram_size-byte UDP payload datagrams."""
+    header_size = PAYLOAD_TS_STRUCT.size if timestamps else PAYLOAD_HEADER_SIZE
+    return header_size, datagram_size - header_size
+
+
+def parse_tcp_request(line):
+    """Parse a "<size>" or versioned range request line into (file_size, offset, length)."""
+    fields = line.decode('utf-8').split()
+    if len(fields) == 1:
+        file_size = int(fields[0])
+        return file_size, 0, file_size
+    if len(fields) == 4 and fields[0] == f"V{REQUEST_VERSION}":
+        file_size, offset, length = (int(field) for field in fields[1:])
+        return file_size, offset, length
+    raise ValueError(f"unsupported request {line!r}")